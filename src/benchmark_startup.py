@@ -0,0 +1,110 @@
+"""
+Startup benchmark for the GUI.
+
+Measures the import time of the main window (python -X importtime) and the wall-clock time until the first
+window is shown. Fails (exit code 1) if a heavy dependency is imported at startup or a threshold is exceeded,
+so it can be used as a regression check:
+
+    python3 benchmark_startup.py --max-import-time 2.0 --max-window-time 4.0
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# must only be imported on first use (gating, report, NIfTI export and segmentation stacks)
+LAZY_MODULES = [
+    'pandas',
+    'shapely',
+    'skimage',
+    'SimpleITK',
+    'pydicom',
+    'gating.contour_based_gating',
+    'report.report',
+    'segmentation.predict',
+    'segmentation.segment',
+    'segmentation.save_as_nifti',
+    'input_output.read_image',
+    'input_output.video_export',
+]
+
+IMPORT_SCRIPT = 'from PyQt5.QtWidgets import QApplication; app = QApplication([]); import gui.gui'
+WINDOW_SCRIPT = '''
+import sys
+from omegaconf import OmegaConf
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+from gui.gui import Master
+window = Master(OmegaConf.load('config.yaml'))
+app.processEvents()
+sys.exit(0)
+'''
+
+
+def run(script):
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')  # no display needed
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script], cwd=SRC_DIR, env=env, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - start_time
+    if result.returncode != 0:
+        print(result.stderr)
+        raise RuntimeError('Startup benchmark script failed')
+
+    return elapsed, result.stderr
+
+
+def parse_importtime(log):
+    """Returns {module: (self_us, cumulative_us)} from the output of python -X importtime"""
+    modules = {}
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:') :].split('|')
+        modules[module.strip()] = (int(self_us), int(cumulative_us))
+
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-import-time', type=float, default=2.0, help='threshold for importing gui.gui (s)')
+    parser.add_argument('--max-window-time', type=float, default=4.0, help='threshold until first window (s)')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    args = parser.parse_args()
+
+    _, log = run(IMPORT_SCRIPT)
+    modules = parse_importtime(log)
+    import_time = modules['gui.gui'][1] / 1e6
+    print('Slowest imports (cumulative):')
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[: args.top]
+    for module, (_, cumulative_us) in slowest:
+        print(f'{cumulative_us / 1e6:>8.3f} s  {module}')
+
+    window_time, _ = run(WINDOW_SCRIPT)
+    print(f'\nImport time gui.gui:   {import_time:.3f} s (threshold {args.max_import_time:.3f} s)')
+    print(f'Time to first window:  {window_time:.3f} s (threshold {args.max_window_time:.3f} s)')
+
+    failed = False
+    eager_modules = [module for module in LAZY_MODULES if module in modules]
+    if eager_modules:
+        print(f'Imported at startup but should be lazy: {", ".join(eager_modules)}')
+        failed = True
+    if import_time > args.max_import_time:
+        print('Import time regression')
+        failed = True
+    if window_time > args.max_window_time:
+        print('Time to first window regression')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@ import itertools
 import numpy as np
 from loguru import logger
 
-from gating.signal_processing import identify_extrema
+from gating.signal_processing import find_extrema
 from gui.popup_windows.frame_range_dialog import StartFramesDialog
 
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QGroupBox, QRadioButton, QDialogButtonBox
@@ -52,11 +52,15 @@ class  GatingMethodDialog(QDialog):
         return image_method, contour_method
 
 
+PHASE_CODES = np.array(['-', 'D', 'S'])  # index 0: not gated, 1: diastolic, 2: systolic
+
+
 class AutomaticGating:
     def __init__(self, main_window, report_data) -> None:
         self.main_window = main_window
         self.report_data = report_data
         self.x = self.report_data['frame'].values  # want 1-based indexing for GUI
+        self.methods = None  # (image_method, contour_method) selected in the dialog
 
     def automatic_gating(self, image_based_signal, contour_based_signal):
         """
@@ -75,81 +79,120 @@ class AutomaticGating:
         dialog = GatingMethodDialog(self.main_window)
         if dialog.exec_():
             image_method, contour_method = dialog.get_methods()
-            if image_method == "maxima":
-                temp_indices = identify_extrema(self.main_window, image_based_signal)
-                image_indices = temp_indices[1]
-            else:
-                image_indices = temp_indices[0]
-            if contour_method == "maxima":
-                temp_indices = identify_extrema(self.main_window, contour_based_signal)
-                contour_indices = temp_indices[1]
-            else:
-                contour_indices = temp_indices[0]
-
-            # Create a list with indices most likely presenting systole/diastole
-            # Take common intersection
-            final_indices = np.intersect1d(image_indices, contour_indices)
-            # print(f"Image based indices: {image_indices}")
-            # print(f"Contour based indices: {contour_indices}")
-            # print(f"Combined indices: {final_indices}")
-            # write_csv_signals(image_based_signal, 
-            #                   contour_based_signal, 
-            #                   image_indices, 
-            #                   contour_indices, 
-            #                   final_indices)
-            # start by initializing every second
-            first_half = final_indices[::2].tolist()
-            second_half = final_indices[1::2].tolist()
-
-            # systolic contours always have higher elliptic ratio intramural because of compression
-            sum_first_half = sum(
-                [
-                    self.report_data.loc[self.report_data['frame'] == frame, 'elliptic_ratio'].values[0]
-                    for frame in first_half
-                ]
-            )
-            sum_second_half = sum(
-                [
-                    self.report_data.loc[self.report_data['frame'] == frame, 'elliptic_ratio'].values[0]
-                    for frame in second_half
-                ]
+            self.methods = image_method, contour_method
+            diastolic_frames, systolic_frames = gate_frames(
+                image_based_signal,
+                contour_based_signal,
+                self.report_data['frame'].values,
+                self.report_data['elliptic_ratio'].values,
+                image_method,
+                contour_method,
+                self.main_window.config.gating.extrema_y_lim,
+                self.main_window.config.gating.extrema_x_lim,
             )
 
-            # reset all phases
-            self.main_window.data['phases'] == '-'
-            self.main_window.gated_frames_dia = []
-            self.main_window.gated_frames_sys = []
+            self.main_window.gated_frames_dia = diastolic_frames.tolist()
+            self.main_window.gated_frames_sys = systolic_frames.tolist()
             self.main_window.diastolic_frame_box.setChecked(False)
             self.main_window.systolic_frame_box.setChecked(False)
+            # reset all phases
+            self.main_window.data['phases'] = phase_list(
+                len(self.main_window.data['phases']), diastolic_frames, systolic_frames
+            )
+
+
+def gate_frames(
+    image_based_signal,
+    contour_based_signal,
+    frames,
+    elliptic_ratio,
+    image_method='maxima',
+    contour_method='extrema',
+    extrema_y_lim=50,
+    extrema_x_lim=6,
+):
+    """
+    Headless automatic gating (no dialog), e.g. for batch processing.
+
+    Parameters:
+    - image_based_signal, contour_based_signal (numpy.ndarray): Filtered gating signals, one value per row of the
+        report arrays.
+    - frames (numpy.ndarray): 1-based frame number of every row (report_data['frame']).
+    - elliptic_ratio (numpy.ndarray): Elliptic ratio of every row (report_data['elliptic_ratio']).
+    - image_method, contour_method (str): 'maxima' or 'extrema'.
+
+    Returns:
+    - diastolic_frames, systolic_frames (numpy.ndarray): Sorted 0-based frame indices.
+    """
+    _, _, final_indices = candidate_indices(
+        image_based_signal, contour_based_signal, image_method, contour_method, extrema_y_lim, extrema_x_lim
+    )
+    return assign_phases(final_indices, frames, elliptic_ratio)
+
+
+def candidate_indices(
+    image_based_signal,
+    contour_based_signal,
+    image_method='maxima',
+    contour_method='extrema',
+    extrema_y_lim=50,
+    extrema_x_lim=6,
+):
+    """Returns the image-based, contour-based and combined (intersection) candidate indices of the signals"""
+    image_extrema, image_maxima = find_extrema(image_based_signal, extrema_y_lim, extrema_x_lim)
+    image_indices = image_maxima if image_method == 'maxima' else image_extrema
+    contour_extrema, contour_maxima = find_extrema(contour_based_signal, extrema_y_lim, extrema_x_lim)
+    contour_indices = contour_maxima if contour_method == 'maxima' else contour_extrema
 
-            if sum_first_half > sum_second_half:
-                self.main_window.gated_frames_dia = second_half
-                self.main_window.gated_frames_sys = first_half
-                self.main_window.gated_frames_dia.sort()
-                self.main_window.gated_frames_sys.sort()
-            else:
-                self.main_window.gated_frames_dia = first_half
-                self.main_window.gated_frames_sys = second_half
-                self.main_window.gated_frames_dia.sort()
-                self.main_window.gated_frames_sys.sort()
-
-            for frame in self.main_window.gated_frames_dia:
-                self.main_window.data['phases'][frame] = 'D'
-            for frame in self.main_window.gated_frames_sys:
-                self.main_window.data['phases'][frame] = 'S'
-
-def write_csv_signals(image_signal, contour_signal, image_indices, contour_indices, combined_indices):
+    # Create a list with indices most likely presenting systole/diastole
+    # Take common intersection (indices are rows of the report arrays)
+    final_indices = np.intersect1d(image_indices, contour_indices)
+
+    return image_indices, contour_indices, final_indices
+
+
+def assign_phases(final_indices, frames, elliptic_ratio):
+    """Splits the candidate indices alternately into diastolic and systolic 0-based frames"""
+    # start by initializing every second
+    first_half = final_indices[::2]
+    second_half = final_indices[1::2]
+
+    # systolic contours always have higher elliptic ratio intramural because of compression
+    elliptic_ratio = np.asarray(elliptic_ratio)
+    if elliptic_ratio[first_half].sum() > elliptic_ratio[second_half].sum():
+        diastolic_indices, systolic_indices = second_half, first_half
+    else:
+        diastolic_indices, systolic_indices = first_half, second_half
+
+    frames = np.asarray(frames) - 1  # 0-based
+    return frames[diastolic_indices], frames[systolic_indices]
+
+
+def phase_list(num_frames, diastolic_frames, systolic_frames):
+    """Phase of every frame ('D', 'S' or '-') written through an array of phase codes"""
+    codes = np.zeros(num_frames, dtype=np.int8)
+    codes[diastolic_frames] = 1
+    codes[systolic_frames] = 2
+
+    return PHASE_CODES[codes].tolist()
+
+
+def write_csv_signals(
+    image_signal, contour_signal, image_indices, contour_indices, combined_indices, out_path, frames=None
+):
+    """Writes the gating signals and candidate indices to a CSV file (frame defaults to the row index)"""
     import pandas as pd
+
+    rows = np.arange(len(image_signal))
     df = pd.DataFrame({
-        'frame': np.arange(len(image_signal)),
+        'frame': rows if frames is None else frames,
         'image_signal': image_signal,
         'contour_signal': contour_signal,
-        'image_indices': np.zeros(len(image_signal)),
-        'contour_indices': np.zeros(len(image_signal)),
-        'combined_indices': np.zeros(len(image_signal)),
+        # 1 if row is in image_indices, contour_indices, combined_indices
+        'image_indices': np.isin(rows, image_indices).astype(float),
+        'contour_indices': np.isin(rows, contour_indices).astype(float),
+        'combined_indices': np.isin(rows, combined_indices).astype(float),
     })
-    # replace the 0 with ones if frame is in image_indices, contour_indices, combined_indices
-    df.loc[df['frame'].isin(image_indices), 'image_indices'] = 1
-    df.loc[df['frame'].isin(contour_indices), 'contour_indices'] = 1
-    df.loc[df['frame'].isin(combined_indices), 'combined_indices'] = 1
-    df.to_csv('/home/yungselm/Documents/AAOCASeg/stats_data/signals.csv')
\ No newline at end of file
+    df.to_csv(out_path)
+
+    return df
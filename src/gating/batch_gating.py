@@ -0,0 +1,212 @@
+import os
+import glob
+import json
+import time
+import hydra
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pydicom as dcm
+import SimpleITK as sitk
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+from loguru import logger
+from shapely.geometry import Polygon
+
+from version import version_file_str
+from gating.signal_processing import prepare_features, derive_signals, store_gating_signal
+from gating.automatic_gating import candidate_indices, assign_phases, phase_list, write_csv_signals
+from gui.utils.geometry import Spline
+from input_output.contours_io import init_contour_versions, stale_frames, mark_metrics_computed
+from report.report import compute_polygon_metrics, farthest_points, closest_points, centroid_center_vector
+
+NON_IMAGE_EXTENSIONS = ('.json', '.xml', '.txt', '.csv', '.npy')
+CONTOUR_KEYS = ['lumen_area', 'lumen_circumf', 'longest_distance', 'shortest_distance', 'elliptic_ratio']
+VECTOR_KEYS = ['vector_length', 'vector_angle']
+POINT_KEYS = ['lumen_centroid', 'farthest_point', 'nearest_point']
+
+
+def find_cases(input_dir):
+    """Returns (image_file, file_name, contour_file) for every image with a json contour file (most recent version)"""
+    contour_files = {}
+    for contour_file in glob.glob(os.path.join(input_dir, '**', '*_contours*.json'), recursive=True):
+        file_name = contour_file[: contour_file.rindex('_contours')]  # as main_window.file_name in read_image
+        contour_files[file_name] = max(contour_files.get(file_name, contour_file), contour_file)
+
+    cases = []
+    for file_name, contour_file in sorted(contour_files.items()):
+        image_files = [
+            file
+            for file in [file_name] + glob.glob(glob.escape(file_name) + '.*')
+            if os.path.isfile(file) and not file.endswith(NON_IMAGE_EXTENSIONS)
+        ]
+        if not image_files:
+            logger.warning(f'No image found for {contour_file}, skipping')
+            continue
+        cases.append((image_files[0], file_name, contour_file))
+
+    return cases
+
+
+def read_case(image_file, contour_file, config):
+    """Reads images, metadata and contours of one case into a headless stand-in for the main window"""
+    metadata = {'frame_rate': 30, 'resolution': 1}  # resolution only scales distances, signals are normalized
+    try:  # DICOM
+        dicom = dcm.read_file(image_file, force=True)
+        images = dicom.pixel_array
+        if images.ndim == 4:  # 3 channel input
+            images = images[:, :, :, 0]
+        metadata['frame_rate'] = dicom.get('Cine Rate', 30)  # same as parse_dicom
+        if dicom.get('PixelSpacing'):
+            metadata['resolution'] = float(dicom.PixelSpacing[0])
+    except AttributeError:  # NIfTi
+        images = sitk.GetArrayFromImage(sitk.ReadImage(image_file))
+    metadata['num_frames'] = images.shape[0]
+
+    with open(contour_file, 'r') as in_file:
+        data = json.load(in_file)
+    num_frames = metadata['num_frames']
+    for key in CONTOUR_KEYS + VECTOR_KEYS:  # might be missing in older or xml-converted files
+        data.setdefault(key, [0] * num_frames)
+    for key in POINT_KEYS:
+        data.setdefault(key, ([[] for _ in range(num_frames)], [[] for _ in range(num_frames)]))
+    data.setdefault('phases', ['-'] * num_frames)
+    data.setdefault('gating_features', {})
+    init_contour_versions(data, num_frames)
+
+    return SimpleNamespace(config=config, data=data, metadata=metadata, images=images)
+
+
+def contour_features(case, frames):
+    """Computes the contour metrics needed for gating, frames already computed for their current contour are skipped
+    (as in compute_all)"""
+    n_points_contour = case.config.display.n_points_contour
+    for frame in stale_frames(case.data, frames):
+        knot_points = [case.data['lumen'][0][frame], case.data['lumen'][1][frame]]
+        lumen_x, lumen_y = Spline(knot_points, n_points_contour).get_unscaled_contour(scaling_factor=1)
+        polygon = Polygon([(x, y) for x, y in zip(lumen_x, lumen_y)])
+
+        _, _, centroid_x, centroid_y = compute_polygon_metrics(case, polygon, frame)
+        longest_distance, _, _ = farthest_points(case, polygon.exterior.coords, frame)
+        shortest_distance, _, _ = closest_points(case, polygon, frame)
+        if shortest_distance != 0:
+            case.data['elliptic_ratio'][frame] = longest_distance / shortest_distance
+        case.data['vector_length'][frame], case.data['vector_angle'][frame] = centroid_center_vector(
+            case, centroid_x, centroid_y
+        )
+        mark_metrics_computed(case.data, frame)
+
+
+def gating_frames(case):
+    """Longest run of consecutive contoured frames (gating needs a contour in every frame)"""
+    contoured_frames = np.flatnonzero([bool(contour) for contour in case.data['lumen'][0]])
+    if not contoured_frames.size:
+        raise ValueError('No contours found')
+    runs = np.split(contoured_frames, np.flatnonzero(np.diff(contoured_frames) > 1) + 1)
+
+    return max(runs, key=len), len(contoured_frames)
+
+
+def offline_gating(case, frames, image_method='maxima', contour_method='extrema'):
+    """
+    Same gating as in the GUI for the given (consecutive) frames of a headless case.
+    Returns the gating signals, the candidate indices and the 0-based diastolic and systolic frames.
+    """
+    report_arrays = {
+        key: np.asarray(case.data[key], dtype=float)[frames]
+        for key in ['shortest_distance', 'vector_angle', 'vector_length', 'elliptic_ratio']
+    }
+    image_signals, contour_signals = prepare_features(case, frames[0], frames[-1] + 1, report_arrays)
+    signals = derive_signals(case, image_signals, contour_signals)
+    indices = candidate_indices(
+        signals[2],  # filtered image-based signal
+        signals[3],  # filtered contour-based signal
+        image_method,
+        contour_method,
+        case.config.gating.extrema_y_lim,
+        case.config.gating.extrema_x_lim,
+    )
+    diastolic_frames, systolic_frames = assign_phases(indices[2], frames + 1, report_arrays['elliptic_ratio'])
+
+    return signals, indices, diastolic_frames, systolic_frames
+
+
+def gate_case(image_file, file_name, contour_file, config):
+    """Gates one case and writes the phases to its contour file, returns the timings of every step (in s)"""
+    config = OmegaConf.create(config)
+    batch_config = config.gating.batch
+    timings = {}
+    start_time = time.perf_counter()
+    case = read_case(image_file, contour_file, config)
+    timings['read'] = time.perf_counter() - start_time
+
+    frames, num_contoured_frames = gating_frames(case)
+    if len(frames) < num_contoured_frames:
+        logger.warning(f'{os.path.basename(file_name)}: gating frames {frames[0] + 1} to {frames[-1] + 1} only')
+    step_time = time.perf_counter()
+    contour_features(case, frames)
+    timings['contours'] = time.perf_counter() - step_time
+
+    step_time = time.perf_counter()
+    signals, indices, diastolic_frames, systolic_frames = offline_gating(
+        case, frames, batch_config.image_method, batch_config.contour_method
+    )
+    store_gating_signal(case, signals)
+    _, _, image_based_gating_filtered, contour_based_gating_filtered = signals
+    image_indices, contour_indices, final_indices = indices
+    case.data['phases'] = phase_list(case.metadata['num_frames'], diastolic_frames, systolic_frames)
+    timings['signals'] = time.perf_counter() - step_time
+
+    step_time = time.perf_counter()
+    with open(file_name + f'_contours_{version_file_str}.json', 'w') as out_file:
+        json.dump(case.data, out_file)
+    output_dir = batch_config.output_dir or os.path.dirname(file_name)
+    os.makedirs(output_dir, exist_ok=True)
+    write_csv_signals(
+        image_based_gating_filtered,
+        contour_based_gating_filtered,
+        image_indices,
+        contour_indices,
+        final_indices,
+        os.path.join(output_dir, f'{os.path.basename(file_name)}_gating_signals.csv'),
+        frames=frames + 1,
+    )
+    timings['write'] = time.perf_counter() - step_time
+    timings['total'] = time.perf_counter() - start_time
+
+    return len(frames), len(diastolic_frames), len(systolic_frames), timings
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def batch_gating(config: DictConfig) -> None:
+    """Automatic gating of all cases with images and contours in gating.batch.input_dir, in parallel"""
+    batch_config = config.gating.batch
+    cases = find_cases(batch_config.input_dir)
+    logger.info(f'Found {len(cases)} cases with contours in {batch_config.input_dir}')
+    config_container = OmegaConf.to_container(config, resolve=True)  # plain dict for the worker processes
+
+    results = {}
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=batch_config.num_workers) as executor:
+        futures = {executor.submit(gate_case, *case, config_container): case for case in cases}
+        for future in as_completed(futures):
+            case_name = os.path.basename(futures[future][1])
+            try:
+                results[case_name] = future.result()
+                logger.info(f'Gated {case_name} in {results[case_name][3]["total"]:.1f} s')
+            except Exception as error:
+                logger.error(f'Gating failed for {case_name}: {error}')
+    total_time = time.perf_counter() - start_time
+
+    steps = ['read', 'contours', 'signals', 'write', 'total']
+    logger.info(f'{"case":<30}{"frames":>8}{"dia":>6}{"sys":>6}' + ''.join(f'{step:>10}' for step in steps))
+    for case_name, (num_frames, num_dia, num_sys, timings) in sorted(results.items()):
+        logger.info(
+            f'{case_name:<30}{num_frames:>8}{num_dia:>6}{num_sys:>6}'
+            + ''.join(f'{timings[step]:>10.2f}' for step in steps)
+        )
+    logger.info(f'Gated {len(results)}/{len(cases)} cases in {total_time:.1f} s ({batch_config.num_workers} workers)')
+
+
+if __name__ == '__main__':
+    batch_gating()
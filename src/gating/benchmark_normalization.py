@@ -0,0 +1,57 @@
+"""
+Benchmark of the normalization modes used for gating (normalize_data) against the previous loop implementation:
+
+    python3 -m gating.benchmark_normalization --frames 1000 5000 20000 --step 100
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from gating.signal_processing import normalize_data
+
+
+def normalize_loop(data, step):
+    """Previous implementation of the step mode (one Python iteration per window), used as reference"""
+    normalized_data = np.zeros_like(data)
+    for i in range(0, len(data), step):
+        segment = data[i : i + step]
+        normalized_data[i : i + step] = (segment - np.mean(segment)) / np.std(segment)
+
+    return normalized_data
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, nargs='+', default=[1000, 5000, 20000], help='signal lengths')
+    parser.add_argument('--step', type=int, default=100, help='window length (normalize_step)')
+    parser.add_argument('--repeats', type=int, default=20, help='repetitions, the best time is reported')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f'{"frames":>8}{"loop (ms)":>12}{"step (ms)":>12}{"sliding (ms)":>14}{"max. diff step":>16}')
+    for num_frames in args.frames:
+        data = rng.normal(size=num_frames)
+        loop_time = best_time(lambda: normalize_loop(data, args.step), args.repeats)
+        step_time = best_time(lambda: normalize_data(data, args.step, 'step'), args.repeats)
+        sliding_time = best_time(lambda: normalize_data(data, args.step, 'sliding'), args.repeats)
+        difference = np.max(np.abs(normalize_loop(data, args.step) - normalize_data(data, args.step, 'step')))
+        print(
+            f'{num_frames:>8}{loop_time * 1000:>12.3f}{step_time * 1000:>12.3f}{sliding_time * 1000:>14.3f}'
+            f'{difference:>16.2e}'
+        )
+
+
+if __name__ == '__main__':
+    main()
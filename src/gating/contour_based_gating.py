@@ -8,10 +8,10 @@ from loguru import logger
 
 from gating.signal_processing import *
 from gui.utils.helpers import connect_consecutive_frames
-from gating.automatic_gating import AutomaticGating
+from gating.automatic_gating import AutomaticGating, candidate_indices
 from gui.popup_windows.message_boxes import ErrorMessage
 from gui.popup_windows.frame_range_dialog import FrameRangeDialog, StartFramesDialog
-from gui.right_half.right_half import toggle_diastolic_frame, toggle_systolic_frame
+from gui.right_half.right_half import toggle_diastolic_frame, toggle_systolic_frame, use_diastolic
 from report.report import report
 
 
@@ -37,6 +37,12 @@ class ContourBasedGating:
         self.frame_marker = None
         self.default_line_color = 'grey'
         self.default_linestyle = (0, (1, 3))
+        self.features = None  # normalized features, independent of filter and extrema parameters
+        self.signal_lines = []
+        self.candidate_markers = None
+        self.background = None  # figure without signal curves, used to only redraw the curves when tuning
+        self.draw_event_id = None
+        self.gating_methods = ('maxima', 'extrema')  # (image, contour) of the last automatic gating, dialog defaults
 
     def __call__(self):
         self.main_window.status_bar.showMessage('Contour-based gating...')
@@ -44,9 +50,10 @@ class ContourBasedGating:
         if not dialog_success:
             self.main_window.status_bar.showMessage(self.main_window.waiting_status)
             return
-        image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered = (
-            prepare_data(self.main_window, self.frames, self.report_data)
-        )
+        self.features = prepare_features(self.main_window, self.lower_limit, self.upper_limit, self.report_data)
+        signals = derive_signals(self.main_window, *self.features)
+        store_gating_signal(self.main_window, signals)
+        image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered = signals
         self.plot_data(
             image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered
         )
@@ -74,6 +81,7 @@ class ContourBasedGating:
                 ErrorMessage(self.main_window, f'Please add contours to frames {str_missing}')
                 return False
             self.frames = self.main_window.images[lower_limit:upper_limit]
+            self.lower_limit, self.upper_limit = lower_limit, upper_limit
             self.x = self.report_data['frame'].values  # want 1-based indexing for GUI
             return True
         return False
@@ -81,30 +89,33 @@ class ContourBasedGating:
     def plot_data(
         self, image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered
     ):
-        # Scale `_nor` signals to the same range
-        min_signal_range = min(np.min(image_based_gating), np.min(contour_based_gating))
-        max_signal_range = max(np.max(image_based_gating), np.max(contour_based_gating))
-
-        # Shift `unfiltered` signals down so their max aligns with the min of the main signals
-        shift_amount = min_signal_range - np.max(image_based_gating)
-        image_based_gating += shift_amount
-
-        shift_amount = min_signal_range - np.max(contour_based_gating)
-        contour_based_gating += shift_amount
+        image_based_gating, contour_based_gating = self.shift_unfiltered(image_based_gating, contour_based_gating)
 
         # Plotting
         self.fig = self.main_window.gating_display.fig
         self.fig.clear()
         self.ax = self.fig.add_subplot()
-
-        self.ax.plot(self.x, image_based_gating_filtered, color='green', label='Image based gating')
-        self.ax.plot(self.x, contour_based_gating_filtered, color='yellow', label='Contour based gating')
-        self.ax.plot(
-            self.x, image_based_gating, color='green', linestyle='dashed', label='Image based gating (unfiltered)'
-        )
-        self.ax.plot(
-            self.x, contour_based_gating, color='yellow', linestyle='dashed', label='Contour based gating (unfiltered)'
-        )
+        self.frame_marker = None
+        self.candidate_markers = None
+        self.background = None
+        if self.draw_event_id is not None:  # the figure is reused by every gating run
+            self.fig.canvas.mpl_disconnect(self.draw_event_id)
+        self.draw_event_id = self.fig.canvas.mpl_connect('draw_event', self.invalidate_background)
+
+        self.signal_lines = [
+            self.ax.plot(self.x, image_based_gating_filtered, color='green', label='Image based gating')[0],
+            self.ax.plot(self.x, contour_based_gating_filtered, color='yellow', label='Contour based gating')[0],
+            self.ax.plot(
+                self.x, image_based_gating, color='green', linestyle='dashed', label='Image based gating (unfiltered)'
+            )[0],
+            self.ax.plot(
+                self.x,
+                contour_based_gating,
+                color='yellow',
+                linestyle='dashed',
+                label='Contour based gating (unfiltered)',
+            )[0],
+        ]
 
         self.ax.set_xlabel('Frame')
         self.ax.get_yaxis().set_visible(False)
@@ -134,6 +145,7 @@ class ContourBasedGating:
             # Show method selection dialog after plot is rendered
             auto_gating = AutomaticGating(self.main_window, self.report_data)
             auto_gating.automatic_gating(image_based_gating_filtered, contour_based_gating_filtered)
+            self.gating_methods = auto_gating.methods or self.gating_methods
             
             # Redraw lines with new automatic gating results
             self.draw_existing_lines(self.main_window.gated_frames_dia, self.main_window.diastole_color_plt)
@@ -142,6 +154,92 @@ class ContourBasedGating:
 
         return True
 
+    def shift_unfiltered(self, image_based_gating, contour_based_gating):
+        # Shift `unfiltered` signals down so their max aligns with the min of the main signals
+        min_signal_range = min(np.min(image_based_gating), np.min(contour_based_gating))
+        image_based_gating = image_based_gating + min_signal_range - np.max(image_based_gating)
+        contour_based_gating = contour_based_gating + min_signal_range - np.max(contour_based_gating)
+
+        return image_based_gating, contour_based_gating
+
+    def refilter(self):
+        """
+        Re-runs only the filter, combination and extrema stages with the current gating config and updates the
+        existing plot in place (no re-computation of features, no re-creation of the figure).
+        Returns the elapsed time in ms or None if gating was not run yet.
+        """
+        if self.features is None or not self.signal_lines:
+            return None
+        start_time = time.perf_counter()
+        signals = derive_signals(self.main_window, *self.features)
+        store_gating_signal(self.main_window, signals)
+        image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered = signals
+        image_based_gating, contour_based_gating = self.shift_unfiltered(image_based_gating, contour_based_gating)
+        curves = [image_based_gating_filtered, contour_based_gating_filtered, image_based_gating, contour_based_gating]
+        for line, curve in zip(self.signal_lines, curves):
+            line.set_ydata(curve)
+
+        # candidate frames as proposed by automatic gating with the methods selected in the last run
+        candidates = candidate_indices(
+            image_based_gating_filtered,
+            contour_based_gating_filtered,
+            *self.gating_methods,
+            self.main_window.config.gating.extrema_y_lim,
+            self.main_window.config.gating.extrema_x_lim,
+        )[2]
+        if self.candidate_markers is None:
+            self.candidate_markers = self.ax.plot([], [], 'x', color=self.default_line_color, label='_nolegend_')[0]
+        self.candidate_markers.set_data(self.x[candidates], image_based_gating_filtered[candidates])
+
+        y_min = min(np.min(curve) for curve in curves)
+        y_max = max(np.max(curve) for curve in curves)
+        y_lim = self.ax.get_ylim()
+        if y_min < y_lim[0] or y_max > y_lim[1]:  # axes change, full redraw
+            margin = 0.05 * (y_max - y_min)
+            self.ax.set_ylim(y_min - margin, y_max + margin)
+            if self.frame_marker:
+                self.frame_marker[0].set_ydata([y_min - margin])
+            self.fig.canvas.draw_idle()
+        else:
+            self.blit_signals()
+
+        return (time.perf_counter() - start_time) * 1000
+
+    def blit_signals(self):
+        """Only redraws the signal curves on top of the cached background"""
+        canvas = self.fig.canvas
+        artists = self.signal_lines + [self.candidate_markers]
+        if self.background is None:
+            for artist in artists:
+                artist.set_visible(False)
+            canvas.draw()
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+            for artist in artists:
+                artist.set_visible(True)
+        canvas.restore_region(self.background)
+        for artist in artists:
+            self.ax.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+
+    def invalidate_background(self, event):
+        self.background = None
+
+    def rerun_automatic_gating(self):
+        """Replaces the gated frames with the result of automatic gating on the current (re-filtered) signals"""
+        if self.features is None or not self.signal_lines:
+            return
+        image_based_gating_filtered = self.signal_lines[0].get_ydata()
+        contour_based_gating_filtered = self.signal_lines[1].get_ydata()
+        auto_gating = AutomaticGating(self.main_window, self.report_data)
+        auto_gating.automatic_gating(image_based_gating_filtered, contour_based_gating_filtered)
+        self.gating_methods = auto_gating.methods or self.gating_methods
+        use_diastolic(self.main_window)  # gated frames were replaced
+        self.remove_lines()
+        self.selected_line = None
+        self.draw_existing_lines(self.main_window.gated_frames_dia, self.main_window.diastole_color_plt)
+        self.draw_existing_lines(self.main_window.gated_frames_sys, self.main_window.systole_color_plt)
+        plt.draw()
+
     def on_click(self, event):
         if self.fig.canvas.cursor().shape() != 0:  # zooming or panning mode
             return
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from gating.signal_processing import standardize_frames
+
+
+class FrameSimilarity:
+    """
+    Lazily filled cache of standardized float32 frame vectors (optionally cropped and downsampled) and of a banded
+    similarity matrix holding the Pearson correlation of every frame with the previous bandwidth frames, used by the
+    correlation search of the small display. Every similarity is a dot product of two vectors and is computed at most
+    once. The band is kept for the whole pullback, vectors only for the max_vectors most recently used frames (enough
+    for lookups around the current frame), which bounds the memory at full resolution.
+    Gating does not use this cache: its consecutive-frame correlation is computed on a cropped region together with
+    the blurring and cached per frame in main_window.data['gating_features'] (see signal_processing.image_features).
+    """
+
+    def __init__(self, images, bandwidth=30, stride=1, crop=None, max_vectors=None):
+        self.images = images
+        self.bandwidth = bandwidth
+        self.stride = stride
+        self.crop = crop  # (x1, x2, y1, y2) or None for the full frame
+        self.max_vectors = max_vectors or 4 * bandwidth
+        self.vectors = OrderedDict()  # standardized vector by frame (least recently used first)
+        self.band = np.full((len(images), bandwidth + 1), np.nan, dtype=np.float32)  # [frame, lag]: frame - lag
+
+    def get_vectors(self, frames):
+        """Standardized vectors of the frames, only frames not in the cache are computed"""
+        missing = [frame for frame in dict.fromkeys(frames) if frame not in self.vectors]
+        if missing:
+            if self.crop is None:
+                images = self.images[missing]
+            else:
+                x1, x2, y1, y2 = self.crop
+                images = self.images[missing, x1:x2, y1:y2]
+            self.vectors.update(zip(missing, standardize_frames(images, self.stride)))
+        for frame in frames:
+            self.vectors.move_to_end(frame)
+        vectors = [self.vectors[frame] for frame in frames]
+        while len(self.vectors) > self.max_vectors:
+            self.vectors.popitem(last=False)
+
+        return vectors
+
+    def similarity(self, frame, previous_frames):
+        """Correlation of the frame with each of the previous frames (at most bandwidth frames before it)"""
+        lags = frame - np.asarray(previous_frames, dtype=int)
+        if np.any((lags < 0) | (lags > self.bandwidth)):
+            raise ValueError(f'Previous frames must be within {self.bandwidth} frames before frame {frame}')
+        missing = np.isnan(self.band[frame, lags])
+        if missing.any():
+            vectors = self.get_vectors([frame] + (frame - lags[missing]).tolist())
+            self.band[frame, lags[missing]] = [np.dot(vector, vectors[0]) for vector in vectors[1:]]
+
+        return self.band[frame, lags].astype(float)
+
+
+def frame_similarity(main_window, bandwidth=30):
+    """Similarity cache of the small display, kept on the main window and recreated when other images are loaded"""
+    stride = main_window.config.display.get('similarity_stride', 1)
+    cache = getattr(main_window, 'frame_similarity', None)
+    outdated = cache is None or cache.images is not main_window.images  # no cache yet or other images loaded
+    if outdated or (cache.stride, cache.bandwidth) != (stride, bandwidth):
+        cache = FrameSimilarity(main_window.images, bandwidth, stride)
+        main_window.frame_similarity = cache
+
+    return cache
@@ -0,0 +1,157 @@
+from collections import deque
+
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi, sosfreqz
+
+from gating.signal_processing import butterworth_sos, standardize_frames, blurring_chunk
+
+
+class OnlineGating:
+    """
+    Streaming variant of the gating for frames arriving one at a time (e.g. during acquisition).
+
+    Compared to the offline gating (prepare_data, gate_frames) all steps are causal:
+    - z-scores and extrema thresholds are computed over a rolling window of the last normalize_step frames
+    - the Butterworth bandpass filter is applied forwards only (sosfilt with filter state)
+    - signals are combined with equal weights
+    - the phase delay of the forward filter is compensated by shifting the detected frames back by filter_delay
+    - an extremum is confirmed as soon as extrema_x_lim later frames are known, hence labels are emitted with a
+        latency of at most max_latency frames
+    Labels are provisional: which alternating group of candidates is systolic is decided by the sum of elliptic
+    ratios so far and might flip early in the pullback, phases() returns the current assignment for all candidates.
+    """
+
+    def __init__(self, config, frame_rate, x1=50, x2=450, y1=50, y2=450):
+        gating = config.gating
+        online = gating.get('online', {})
+        self.crop = (x1, x2, y1, y2)
+        self.window = gating.normalize_step or 100  # a global z-score needs the full pullback
+        self.extrema_y_lim = gating.extrema_y_lim
+        self.extrema_x_lim = gating.extrema_x_lim
+        self.match_tolerance = online.get('match_tolerance', 2)
+        self.sos = butterworth_sos(int(gating.order), float(gating.lowcut), float(gating.highcut), float(frame_rate))
+        self.filter_delay = filter_delay(self.sos, np.sqrt(gating.lowcut * gating.highcut), frame_rate)
+        # frame i is labelled once frame i + 1 (correlation), the filter delay, x_lim later frames (extremum) and
+        # the matching tolerance are known
+        self.max_latency = 1 + self.filter_delay + self.extrema_x_lim + self.match_tolerance
+
+        self.num_frames = 0
+        self.previous_frame = None
+        self.previous_contour = None
+        self.use_contours = False
+        self.filter_state = None
+        self.raw = deque(maxlen=self.window)  # raw features (correlation, blurring, contour features) per frame
+        self.image_signal = []
+        self.contour_signal = []
+        self.elliptic_ratio = []
+        self.image_maxima = set()
+        self.contour_extrema = set()
+        self.candidates = []
+
+    def push(self, frame, contour_features=None):
+        """
+        Adds the next frame of the pullback.
+
+        Parameters:
+        - frame (numpy.ndarray): The image.
+        - contour_features (dict): shortest_distance, vector_angle, vector_length and elliptic_ratio of the lumen
+            contour of this frame (None if not available, then only the image-based signal is used).
+
+        Returns:
+        - events (list): (frame index, 'D' or 'S') for every frame labelled with this push (provisional labels).
+        """
+        x1, x2, y1, y2 = self.crop
+        vector = standardize_frames(frame[None, x1:x2, y1:y2])[0]
+        blurring = blurring_chunk(frame[None, x1:x2, y1:y2])[0]
+        self.num_frames += 1
+        if self.previous_frame is None:  # first frame, its correlation is known with the next frame
+            self.previous_frame = (vector, blurring, contour_features)
+            self.use_contours = contour_features is not None
+            return []
+        previous_vector, previous_blurring, previous_contour_features = self.previous_frame
+        correlation = float(np.dot(previous_vector, vector))
+        self.previous_frame = (vector, blurring, contour_features)
+
+        # contour signals are shifted by one frame to align with the current frame (as in prepare_data)
+        shifted_contour = self.previous_contour
+        self.previous_contour = previous_contour_features
+        contour_values = [0, 0, 0]
+        if shifted_contour is not None:
+            contour_values = [shifted_contour[key] for key in ['shortest_distance', 'vector_angle', 'vector_length']]
+        self.elliptic_ratio.append(
+            previous_contour_features['elliptic_ratio'] if previous_contour_features is not None else 0
+        )
+        self.add_sample(np.array([correlation, previous_blurring] + contour_values, dtype=float))
+
+        return self.detect(len(self.image_signal) - 1)
+
+    def add_sample(self, features):
+        """Rolling z-score, causal bandpass filter and combination of one sample of all features"""
+        self.raw.append(features)
+        window = np.array(self.raw)
+        std = window.std(axis=0)
+        std[std == 0] = 1
+        normalized = (features - window.mean(axis=0)) / std
+        if self.filter_state is None:  # start in steady state to avoid the step response
+            self.filter_state = sosfilt_zi(self.sos)[:, None, :] * normalized[None, :, None]
+        filtered, self.filter_state = sosfilt(self.sos, normalized[:, None], axis=1, zi=self.filter_state)
+        filtered = filtered[:, 0]
+        self.image_signal.append(filtered[:2].mean())
+        self.contour_signal.append(filtered[2:].mean())
+
+    def detect(self, last_index):
+        """Confirms extrema and candidates that can no longer change, returns newly labelled frames"""
+        extremum_index = last_index - self.extrema_x_lim
+        if extremum_index < 0:
+            return []
+        image_extremum = self.extremum(self.image_signal, extremum_index)
+        if image_extremum == 'max':
+            self.image_maxima.add(extremum_index)
+        if self.extremum(self.contour_signal, extremum_index) is not None:
+            self.contour_extrema.add(extremum_index)
+
+        candidate_index = extremum_index - self.match_tolerance
+        if candidate_index not in self.image_maxima:
+            return []
+        if self.use_contours and not any(
+            index in self.contour_extrema
+            for index in range(candidate_index - self.match_tolerance, candidate_index + self.match_tolerance + 1)
+        ):
+            return []
+        frame_index = candidate_index - self.filter_delay
+        if frame_index < 0:
+            return []
+        self.candidates.append(frame_index)
+        diastolic_frames, systolic_frames = self.phases()
+
+        return [(frame_index, 'D' if frame_index in diastolic_frames else 'S')]
+
+    def extremum(self, signal, index):
+        """'max' or 'min' if signal[index] is an extremum within extrema_x_lim frames above/below the rolling
+        percentile threshold (as find_extrema), else None"""
+        neighbours = signal[max(0, index - self.extrema_x_lim) : index + self.extrema_x_lim + 1]
+        threshold = np.percentile(signal[-self.window :], self.extrema_y_lim)
+        if signal[index] == max(neighbours) and signal[index] >= threshold:
+            return 'max'
+        if signal[index] == min(neighbours) and signal[index] <= threshold:
+            return 'min'
+        return None
+
+    def phases(self):
+        """Current assignment of all candidates, returns 0-based diastolic and systolic frames"""
+        candidates = np.array(self.candidates, dtype=int)
+        elliptic_ratio = np.array(self.elliptic_ratio)
+        first_half = candidates[::2]
+        second_half = candidates[1::2]
+        # systolic contours always have higher elliptic ratio intramural because of compression
+        if elliptic_ratio[first_half].sum() > elliptic_ratio[second_half].sum():
+            return second_half, first_half
+        return first_half, second_half
+
+
+def filter_delay(sos, frequency, fs):
+    """Phase delay (in frames, rounded) of the forward filter at the given frequency"""
+    _, response = sosfreqz(sos, worN=np.linspace(0, frequency, 512), fs=fs)
+    phase = np.unwrap(np.angle(response))[-1]
+
+    return max(0, round(-phase / (2 * np.pi * frequency) * fs))
@@ -0,0 +1,111 @@
+import os
+import time
+import hydra
+
+import numpy as np
+from omegaconf import DictConfig
+from loguru import logger
+
+from gating.online_gating import OnlineGating
+from gating.batch_gating import find_cases, read_case, gating_frames, contour_features, offline_gating
+
+
+def replay_frames(images, frame_rate, speed=1.0):
+    """Yields (index, frame, arrival time) as if the frames were acquired at the frame rate (speed 0: no waiting)"""
+    start_time = time.perf_counter()
+    for index, frame in enumerate(images):
+        if speed > 0:
+            arrival_time = start_time + index / (frame_rate * speed)
+            time.sleep(max(0, arrival_time - time.perf_counter()))
+        yield index, frame, time.perf_counter()
+
+
+def agreement(reference, estimate, tolerance):
+    """Fraction of reference frames with an estimated frame of the same phase within tolerance frames"""
+    if not len(reference):
+        return np.nan
+    estimate = np.asarray(estimate)
+    return np.mean([np.any(np.abs(estimate - frame) <= tolerance) for frame in reference]) if estimate.size else 0.0
+
+
+def replay_case(case, frames, speed):
+    """Streams the frames through OnlineGating, returns the online phases, latencies (frames, s) and push times"""
+    online_gating = OnlineGating(case.config, case.metadata['frame_rate'])
+    arrival_times = []
+    latencies_frames = []
+    latencies_seconds = []
+    push_times = []
+    keys = ['shortest_distance', 'vector_angle', 'vector_length', 'elliptic_ratio']
+    for index, frame, arrival_time in replay_frames(
+        case.images[frames[0] : frames[-1] + 1], case.metadata['frame_rate'], speed
+    ):
+        arrival_times.append(arrival_time)
+        features = {key: case.data[key][frames[index]] for key in keys}
+        events = online_gating.push(frame, features)
+        now = time.perf_counter()
+        push_times.append(now - arrival_time)
+        for event_index, _ in events:
+            latencies_frames.append(index - event_index)
+            latencies_seconds.append(now - arrival_times[event_index])
+    diastolic_frames, systolic_frames = online_gating.phases()
+
+    return (
+        frames[diastolic_frames],
+        frames[systolic_frames],
+        np.array(latencies_frames),
+        np.array(latencies_seconds),
+        np.array(push_times),
+    )
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def replay_gating(config: DictConfig) -> None:
+    """
+    Replays all cases in gating.batch.input_dir frame by frame through the online gating and reports the latency of
+    the provisional labels and their agreement with the offline gating
+    """
+    speed = config.gating.online.replay_speed
+    tolerance = config.gating.online.match_tolerance
+    cases = find_cases(config.gating.batch.input_dir)
+    logger.info(f'Found {len(cases)} cases with contours in {config.gating.batch.input_dir}')
+
+    results = {}
+    for image_file, file_name, contour_file in cases:
+        case_name = os.path.basename(file_name)
+        case = read_case(image_file, contour_file, config)
+        frames, _ = gating_frames(case)
+        contour_features(case, frames)
+        _, _, offline_dia, offline_sys = offline_gating(
+            case, frames, config.gating.batch.image_method, config.gating.batch.contour_method
+        )
+        online_dia, online_sys, latencies_frames, latencies_seconds, push_times = replay_case(case, frames, speed)
+        results[case_name] = (
+            len(frames),
+            agreement(np.concatenate([offline_dia, offline_sys]), np.concatenate([online_dia, online_sys]), tolerance),
+            np.nanmean([agreement(offline_dia, online_dia, tolerance), agreement(offline_sys, online_sys, tolerance)]),
+            np.max(latencies_frames, initial=0),
+            np.mean(latencies_seconds) if latencies_seconds.size else np.nan,
+            np.mean(push_times) * 1000,
+        )
+        logger.info(
+            f'{case_name}: offline {len(offline_dia)}/{len(offline_sys)}, online {len(online_dia)}/{len(online_sys)} '
+            'diastolic/systolic frames'
+        )
+
+    logger.info(
+        f'{"case":<30}{"frames":>8}{"gated":>8}{"phase":>8}{"max lat. (frames)":>20}{"mean lat. (s)":>16}'
+        f'{"ms/frame":>10}'
+    )
+    for case_name, (num_frames, gated, phase, max_latency, mean_latency, push_time) in results.items():
+        logger.info(
+            f'{case_name:<30}{num_frames:>8}{gated:>8.2f}{phase:>8.2f}{max_latency:>20}{mean_latency:>16.3f}'
+            f'{push_time:>10.2f}'
+        )
+    logger.info(
+        f'gated: offline gated frames matched by an online label within {tolerance} frames, '
+        'phase: same with matching phase'
+    )
+
+
+if __name__ == '__main__':
+    replay_gating()
@@ -1,8 +1,10 @@
 import time
+import functools
 import numpy as np
 from loguru import logger
-from scipy.signal import find_peaks, butter, filtfilt
-import cv2
+import scipy.fft
+from omegaconf import OmegaConf
+from scipy.signal import find_peaks, butter, sosfiltfilt
 
 
 def timing_decorator(func):
@@ -17,130 +19,275 @@ def timing_decorator(func):
 
 
 @timing_decorator
-def prepare_data(main_window, frames, report_data, x1=50, x2=450, y1=50, y2=450):
-    """Prepares data for plotting."""
-    try:
-        gating_signal = main_window.data['gating_signal']
-        if not gating_signal:  # skip if empty
-            raise KeyError
-        if gating_signal['gating_config'] == main_window.config.gating and len(
-            gating_signal['image_based_gating']
-        ) == len(frames):
-            return (
-                gating_signal['image_based_gating'],
-                gating_signal['contour_based_gating'],
-                gating_signal['image_based_gating_filtered'],
-                gating_signal['contour_based_gating_filtered'],
-            )
-    except KeyError:
-        pass
-
-    # Initialize variables
+def prepare_data(main_window, lower_limit, upper_limit, report_data, x1=50, x2=450, y1=50, y2=450):
+    """
+    Prepares data for plotting.
+    Raw per-frame features are cached and only computed once per frame, hence changing the frame range or any
+    filter parameter only re-runs the cheap derived stage (normalization, bandpass filter, combination).
+    """
+    image_signals, contour_signals = prepare_features(
+        main_window, lower_limit, upper_limit, report_data, x1, x2, y1, y2
+    )
+    signals = derive_signals(main_window, image_signals, contour_signals)
+    store_gating_signal(main_window, signals)
+
+    return signals
+
+
+def prepare_features(main_window, lower_limit, upper_limit, report_data, x1=50, x2=450, y1=50, y2=450):
+    """
+    Returns the normalized image-based (correlation, blurring) and contour-based (shortest distance, vector angle,
+    vector length) features for the frame range. These do not depend on the filter and extrema parameters.
+    """
+    correlation, blurring = image_features(main_window, lower_limit, upper_limit, x1, x2, y1, y2)
+    return normalize_features(
+        main_window,
+        correlation,
+        blurring,
+        report_data['shortest_distance'],
+        report_data['vector_angle'],
+        report_data['vector_length'],
+    )
+
+
+def store_gating_signal(main_window, signals):
+    image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered = signals
+    main_window.data['gating_signal'] = {
+        'image_based_gating': list(image_based_gating),
+        'contour_based_gating': list(contour_based_gating),
+        'image_based_gating_filtered': list(image_based_gating_filtered),
+        'contour_based_gating_filtered': list(contour_based_gating_filtered),
+        'gating_config': OmegaConf.to_container(main_window.config.gating),
+    }
+
+
+def image_features(main_window, lower_limit, upper_limit, x1=50, x2=450, y1=50, y2=450):
+    """
+    Returns the raw correlation and blurring for the frame range, computing only frames missing in the cache.
+    The cache (main_window.data['gating_features']) holds one value per frame of the pullback (NaN if not yet
+    computed) and is saved with the contours. It is reset if the cropped region changes.
+    """
+    num_frames = main_window.metadata['num_frames']
+    crop = [x1, x2, y1, y2]
+    features = main_window.data.get('gating_features') or {}
+    if features.get('crop') != crop or len(features.get('blurring', [])) != num_frames:
+        features = {'crop': crop, 'correlation': [np.nan] * num_frames, 'blurring': [np.nan] * num_frames}
+    correlation = np.asarray(features['correlation'], dtype=float)  # correlation of frame with next frame
+    blurring = np.asarray(features['blurring'], dtype=float)
+
+    missing = np.isnan(blurring[lower_limit:upper_limit])
+    missing[:-1] |= np.isnan(correlation[lower_limit : upper_limit - 1])  # last frame has no next frame in range
+    missing_frames = np.flatnonzero(missing) + lower_limit
+    if missing_frames.size:
+        memory_budget_mb = main_window.config.gating.get('memory_budget_mb', 512)
+        chunk_size = chunk_size_from_budget((x2 - x1, y2 - y1), memory_budget_mb)
+        # compute contiguous runs of missing frames, including the following frame for the correlation
+        runs = np.split(missing_frames, np.flatnonzero(np.diff(missing_frames) > 1) + 1)
+        for run in runs:
+            start, end = run[0], run[-1] + 1
+            frames = main_window.images[start : min(end + 1, num_frames), x1:x2, y1:y2]
+            run_correlation, run_blurring = calculate_image_signals(frames, chunk_size)
+            correlation[start:end] = run_correlation[: end - start]
+            blurring[start:end] = run_blurring[: end - start]
+    logger.info(
+        f'Image-based gating features: computed {missing_frames.size}, '
+        f'cached {upper_limit - lower_limit - missing_frames.size} frames'
+    )
+    features['correlation'] = correlation.tolist()
+    features['blurring'] = blurring.tolist()
+    main_window.data['gating_features'] = features
+
+    correlation = correlation[lower_limit:upper_limit].copy()
+    correlation[-1] = 0  # no next frame in range
+
+    return correlation, blurring[lower_limit:upper_limit].copy()
+
+
+def normalize_features(main_window, correlation, blurring, shortest_distance, vector_angle, vector_length):
+    """Normalizes the raw features, returns lists of image-based and contour-based signals"""
     step = main_window.config.gating.normalize_step
-    maxima_only = main_window.config.gating.maxima_only
-    # Crop frames to a specific region
-    frames = frames[:, x1:x2, y1:y2]
+    mode = main_window.config.gating.get('normalize_mode', 'step')
 
     # Normalize signals
-    correlation = normalize_data(calculate_correlation(frames), step)
-    blurring = normalize_data(calculate_blurring_fft(frames), step)
-    # shortest_dist = normalize_data(report_data['shortest_distance'], step)
-    # vector_angle = normalize_data(report_data['vector_angle'], step)
-    # vector_length = normalize_data(report_data['vector_length'], step)
+    correlation = normalize_data(correlation, step, mode)
+    blurring = normalize_data(blurring, step, mode)
     # Shift contour signals to align with current frame
-    shortest_dist = normalize_data(np.roll(report_data['shortest_distance'], 1), step)
-    vector_angle = normalize_data(np.roll(report_data['vector_angle'], 1), step)
-    vector_length = normalize_data(np.roll(report_data['vector_length'], 1), step)
-    
+    shortest_dist = normalize_data(np.roll(shortest_distance, 1), step, mode)
+    vector_angle = normalize_data(np.roll(vector_angle, 1), step, mode)
+    vector_length = normalize_data(np.roll(vector_length, 1), step, mode)
+
     # Set first frame to 0 (no previous frame)
     shortest_dist[0] = 0
     vector_angle[0] = 0
     vector_length[0] = 0
 
-    signal_image_based_filtered = [
-        bandpass_filter(main_window, correlation),
-        bandpass_filter(main_window, blurring),
-    ]
-    signal_contour_based_filtered = [
-        bandpass_filter(main_window, shortest_dist),
-        bandpass_filter(main_window, vector_angle),
-        bandpass_filter(main_window, vector_length),
-    ]
-    image_based_gating = combined_signal(main_window, [correlation, blurring], maxima_only=maxima_only)
+    return [correlation, blurring], [shortest_dist, vector_angle, vector_length]
+
+
+@timing_decorator
+def derive_signals(main_window, image_signals, contour_signals):
+    """
+    Filters and combines the normalized features into the image-based and contour-based gating signals.
+    Only depends on the filter (lowcut, highcut, order) and extrema parameters, hence can be re-run on its own
+    when tuning these.
+    """
+    maxima_only = main_window.config.gating.maxima_only
+
+    filtered = bandpass_filter(main_window, np.vstack(image_signals + contour_signals))  # all signals in one call
+    signal_image_based_filtered = list(filtered[: len(image_signals)])
+    signal_contour_based_filtered = list(filtered[len(image_signals) :])
+    image_based_gating = combined_signal(main_window, image_signals, maxima_only=maxima_only)
     image_based_gating_filtered = combined_signal(main_window, signal_image_based_filtered, maxima_only=maxima_only)
-    contour_based_gating = combined_signal(main_window, [shortest_dist, vector_angle, vector_length], maxima_only=False)
+    contour_based_gating = combined_signal(main_window, contour_signals, maxima_only=False)
     contour_based_gating_filtered = combined_signal(main_window, signal_contour_based_filtered, maxima_only=False)
 
-    main_window.data['gating_signal'] = {
-        'image_based_gating': list(image_based_gating),
-        'contour_based_gating': list(contour_based_gating),
-        'image_based_gating_filtered': list(image_based_gating_filtered),
-        'contour_based_gating_filtered': list(contour_based_gating_filtered),
-        'gating_config': dict(main_window.config.gating),
-    }
-
     return image_based_gating, contour_based_gating, image_based_gating_filtered, contour_based_gating_filtered
 
 
-def normalize_data(data, step):
-    # z-score normalization either for full set, or defined steps
-    if step == 0:
-        return (data - np.mean(data)) / np.std(data)
-    else:
-        normalized_data = np.zeros_like(data)
+def normalize_data(data, step, mode='step'):
+    """
+    z-score normalization either for full set (step=0), or per window of length step:
+    - 'step': non-overlapping windows (the last window contains the remaining frames)
+    - 'sliding': centred sliding window (shrinks at the borders), no discontinuities at window borders
+    Constant windows are normalized to 0.
+    """
+    data = np.asarray(data, dtype=float)
+    if step == 0 or step >= len(data):
+        return zscore(data, data.mean(), data.std())
+    if mode == 'sliding':
+        return sliding_normalize(data, step)
+
+    normalized_data = np.empty_like(data)
+    num_full = len(data) // step * step
+    windows = data[:num_full].reshape(-1, step)  # one row per full window
+    normalized_data[:num_full] = zscore(
+        windows, windows.mean(axis=1, keepdims=True), windows.std(axis=1, keepdims=True)
+    ).ravel()
+    if num_full < len(data):  # remaining frames
+        tail = data[num_full:]
+        normalized_data[num_full:] = zscore(tail, tail.mean(), tail.std())
+
+    return normalized_data
+
+
+def sliding_normalize(data, window):
+    """z-score over a centred sliding window, computed with cumulative sums in O(n)"""
+    data = data - data.mean()  # reduces cancellation in the sum of squares
+    cumsum = np.concatenate(([0], np.cumsum(data)))
+    cumsum_squares = np.concatenate(([0], np.cumsum(data**2)))
+    indices = np.arange(len(data))
+    start = np.maximum(indices - window // 2, 0)
+    end = np.minimum(indices - window // 2 + window, len(data))
+    count = end - start
+    mean = (cumsum[end] - cumsum[start]) / count
+    variance = np.maximum((cumsum_squares[end] - cumsum_squares[start]) / count - mean**2, 0)
+
+    return zscore(data, mean, np.sqrt(variance))
+
+
+def zscore(data, mean, std):
+    std = np.where(std > 0, std, np.inf)  # constant data -> 0
+    return (data - mean) / std
+
+
+def standardize_frames(frames, stride=1):
+    """
+    Flattens every frame to a zero-mean, unit-norm float32 vector (optionally downsampled by stride).
+    The dot product of two such vectors equals the Pearson correlation of the (downsampled) frames.
+    """
+    vectors = np.asarray(frames)[:, ::stride, ::stride].reshape(len(frames), -1).astype(np.float32)
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1  # constant frames (e.g. black) have no variance
+    vectors /= norms
+
+    return vectors
+
+
+def chunk_size_from_budget(frame_shape, memory_budget_mb):
+    """Number of frames per chunk so that the buffers of calculate_image_signals stay within the memory budget"""
+    # per pixel: float32 frame + standardized vector, complex64 half spectrum, float32 magnitudes (half + full)
+    bytes_per_frame = frame_shape[0] * frame_shape[1] * 24
+    return max(2, int(memory_budget_mb * 1024**2 // bytes_per_frame))
+
+
+def iter_chunks(frames, chunk_size, overlap=0):
+    """
+    Yields (offset, chunk) for consecutive chunks of frames, every chunk additionally contains the last
+    overlap frames of the previous chunk (offset is the number of these frames).
+    Only the current chunk is loaded into memory, hence frames can be a memory-mapped array.
+    """
+    for start in range(0, len(frames), chunk_size):
+        first = max(0, start - overlap)
+        yield start - first, np.asarray(frames[first : start + chunk_size])
+
+
+def correlation_chunk(chunk):
+    """Correlation coefficients between consecutive frames of one chunk (length len(chunk) - 1)"""
+    vectors = standardize_frames(chunk)  # standardized once, the correlations are then row-wise dot products
+    return np.einsum('ij,ij->i', vectors[:-1], vectors[1:])
+
+
+def blurring_chunk(chunk):
+    """Average of the 10% highest frequency magnitudes for every frame of one chunk"""
+    num_frames, height, width = chunk.shape
+    n = height * width
+    threshold_index = int(0.9 * n)
+    magnitude_spectrum = np.abs(scipy.fft.rfft2(chunk.astype(np.float32), workers=-1))
+    # the real FFT only contains half of the (conjugate symmetric) spectrum, restore the full set of magnitudes
+    # (fftshift is not needed since only the magnitudes are used, not their position)
+    interior = magnitude_spectrum[:, :, 1 : (width + 1) // 2]  # columns present twice in the full spectrum
+    edges = [magnitude_spectrum[:, :, :1]]
+    if width % 2 == 0:  # Nyquist column only present once
+        edges.append(magnitude_spectrum[:, :, width // 2 :])
+    magnitudes = np.concatenate(edges + [interior, interior], axis=2).reshape(num_frames, n)
 
-        for i in range(0, len(data), step):
-            segment = data[i : i + step]
+    # Use np.partition to get the 10% highest frequencies
+    highest_frequencies = np.partition(magnitudes, threshold_index, axis=1)[:, threshold_index:]
 
-            segment_normalized = (segment - np.mean(segment)) / np.std(segment)
+    return highest_frequencies.mean(axis=1)
 
-            normalized_data[i : i + step] = segment_normalized
 
-        return normalized_data
+@timing_decorator
+def calculate_image_signals(frames, chunk_size=256):
+    """
+    Calculates correlation and blurring in a single pass over the frames, reading every chunk only once.
+    Consecutive chunks overlap by one frame to compute the correlation across chunk borders.
+    """
+    correlations = np.zeros(len(frames))  # last entry stays 0 to match the length of the frames
+    blurring_scores = np.zeros(len(frames))
+    start = 0
+    for offset, chunk in iter_chunks(frames, chunk_size, overlap=1):
+        correlations[start - offset : start - offset + len(chunk) - 1] = correlation_chunk(chunk)
+        blurring_scores[start : start + len(chunk) - offset] = blurring_chunk(chunk[offset:])
+        start += len(chunk) - offset
+
+    return correlations, blurring_scores
 
 
 @timing_decorator
-def calculate_correlation(frames):
+def calculate_correlation(frames, chunk_size=256):
     """Calculates correlation coefficients between consecutive frames."""
-    correlations = []
-    for i in range(len(frames) - 1):
-        corr = np.corrcoef(frames[i].ravel(), frames[i + 1].ravel())[0, 1]
-        correlations.append(corr)
-    correlations.append(0)  # to match the length of the frames
+    correlations = np.zeros(len(frames))  # last entry stays 0 to match the length of the frames
+    start = 0
+    for offset, chunk in iter_chunks(frames, chunk_size, overlap=1):
+        correlations[start - offset : start - offset + len(chunk) - 1] = correlation_chunk(chunk)
+        start += len(chunk) - offset
 
     return correlations
 
 
 @timing_decorator
-def calculate_blurring_fft(frames):
+def calculate_blurring_fft(frames, chunk_size=256):
     """Calculates blurring using Fast Fourier Transform. Takes the average of the 10% highest frequencies."""
-    blurring_scores = []
-    for frame in frames:
-        fft_data = np.fft.fft2(frame)
-        fft_shifted = np.fft.fftshift(fft_data)
-        magnitude_spectrum = np.abs(fft_shifted)
-
-        # Use np.partition to get the 10% highest frequencies
-        n = len(magnitude_spectrum.ravel())
-        threshold_index = int(0.9 * n)
-        highest_frequencies = np.partition(magnitude_spectrum.ravel(), threshold_index)[threshold_index:]
-        blurring_score = np.mean(highest_frequencies)
-        blurring_scores.append(blurring_score)
-
-    return blurring_scores
-    # blurring_scores = []
-    # for frame in frames:
-    #     # use cv2.Laplacian to calculate the blurring, should return same format as above
-    #     laplacian = cv2.Laplacian(frame, cv2.CV_64F)
-    #     magnitude_spectrum = np.abs(laplacian)
-
-    #     n = len(magnitude_spectrum.ravel())
-    #     threshold_index = int(0.9 * n)
-    #     highest_frequencies = np.partition(laplacian.ravel(), threshold_index)[threshold_index:]
-    #     blurring_score = np.mean(highest_frequencies)
-    #     blurring_scores.append(blurring_score)
-
-    # return blurring_scores
+    return np.concatenate([blurring_chunk(chunk) for _, chunk in iter_chunks(frames, chunk_size)])
+
+
+@functools.lru_cache(maxsize=32)
+def butterworth_sos(order, lowcut, highcut, fs):
+    """Butterworth bandpass filter design in second-order sections (numerically stable for higher orders)"""
+    nyquist = 0.5 * fs
+    return butter(order, [lowcut / nyquist, highcut / nyquist], btype='band', output='sos')
 
 
 def bandpass_filter(main_window, signal):
@@ -148,25 +295,21 @@ def bandpass_filter(main_window, signal):
     Applies a Butterworth bandpass filter to the input signal using instance parameters.
 
     Parameters:
-    - signal (array-like): The input signal to filter.
+    - signal (array-like): The input signal to filter, or a 2D array of signals (one per row).
 
     Returns:
-    - filtered_signal (numpy.ndarray): The bandpass filtered signal.
+    - filtered_signal (numpy.ndarray): The bandpass filtered signal(s).
     """
     lowcut = main_window.config.gating.lowcut
     highcut = main_window.config.gating.highcut
     order = main_window.config.gating.order
     fs = main_window.metadata['frame_rate']  # for Butterworth filter
 
-    nyquist = 0.5 * fs
-    low = lowcut / nyquist
-    high = highcut / nyquist
+    # Design Butterworth bandpass filter (cached, only re-designed if a parameter changes)
+    sos = butterworth_sos(int(order), float(lowcut), float(highcut), float(fs))
 
-    # Design Butterworth bandpass filter
-    b, a = butter(order, [low, high], btype='band')
-
-    # Apply filter using filtfilt for zero phase distortion
-    filtered_signal = filtfilt(b, a, signal)
+    # Apply filter forwards and backwards for zero phase distortion
+    filtered_signal = sosfiltfilt(sos, signal, axis=-1)
 
     return filtered_signal
 
@@ -224,6 +367,11 @@ def identify_extrema(main_window, signal):
     extrema_y_lim = main_window.config.gating.extrema_y_lim
     extrema_x_lim = main_window.config.gating.extrema_x_lim
 
+    return find_extrema(signal, extrema_y_lim, extrema_x_lim)
+
+
+def find_extrema(signal, extrema_y_lim=50, extrema_x_lim=6):
+    """Returns the indices of all extrema (sorted) and of the maxima only"""
     # Remove NaN and infinite values from the signal
     signal = np.nan_to_num(signal, nan=0.0, posinf=0.0, neginf=0.0)
     
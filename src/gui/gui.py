@@ -12,8 +12,6 @@ from gui.left_half.left_half import LeftHalf
 from gui.right_half.right_half import RightHalf
 from gui.shortcuts import init_shortcuts, init_menu
 from input_output.contours_io import write_contours
-from gating.contour_based_gating import ContourBasedGating
-from segmentation.predict import Predict
 
 
 class Master(QMainWindow):
@@ -24,8 +22,8 @@ class Master(QMainWindow):
         self.config = config
         self.file_name = None  # Ensure file_name is initialized
         self.autosave_interval = config.save.autosave_interval
-        self.contour_based_gating = ContourBasedGating(self)
-        self.predictor = Predict(self)
+        self._contour_based_gating = None  # gating and segmentation stacks are only imported on first use
+        self._predictor = None
         self.image_displayed = False
         self.contours_drawn = False
         self.hide_contours = False
@@ -50,6 +48,30 @@ class Master(QMainWindow):
         self.init_gui()
         init_shortcuts(self)
 
+    @property
+    def contour_based_gating(self):
+        if self._contour_based_gating is None:
+            from gating.contour_based_gating import ContourBasedGating
+
+            self._contour_based_gating = ContourBasedGating(self)
+        return self._contour_based_gating
+
+    @property
+    def gating_loaded(self):
+        """Whether the gating was used already (without importing it, unlike contour_based_gating)"""
+        return self._contour_based_gating is not None
+
+    @property
+    def predictor(self):
+        if self._predictor is None:
+            from segmentation.predict import Predict
+
+            self._predictor = Predict(self)
+        return self._predictor
+
+    def run_gating(self):
+        self.contour_based_gating()
+
     def init_gui(self):
         self.menu_bar = QMenuBar(self)
         self.setMenuBar(self.menu_bar)
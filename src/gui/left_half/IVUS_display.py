@@ -1,17 +1,25 @@
 import math
 import cv2
+from collections import OrderedDict
 
 import numpy as np
 from loguru import logger
 from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsTextItem
 from PyQt5.QtCore import Qt, QLineF, QPointF
 from PyQt5.QtGui import QPixmap, QImage, QColor, QFont, QPen
-from shapely.geometry import Polygon
 
 from gui.utils.geometry import Point, Spline, get_qt_pen
+from gui.utils.helpers import lazy_import
 from gui.right_half.longitudinal_view import Marker
-from report.report import compute_polygon_metrics, farthest_points, closest_points
-from segmentation.segment import downsample
+from input_output.contours_io import bump_contour_version
+
+Polygon = lazy_import('shapely.geometry', 'Polygon')
+compute_polygon_metrics = lazy_import('report.report', 'compute_polygon_metrics')
+farthest_points = lazy_import('report.report', 'farthest_points')
+closest_points = lazy_import('report.report', 'closest_points')
+downsample = lazy_import('segmentation.segment', 'downsample')
+
+IMAGE_CACHE_SIZE = 32  # rendered images kept for playback and going back and forth between frames
 
 
 class IVUSDisplay(QGraphicsView):
@@ -51,6 +59,7 @@ class IVUSDisplay(QGraphicsView):
         self.initial_window_width = 256  # window width is the range of pixel values that are displayed
         self.window_level = self.initial_window_level
         self.window_width = self.initial_window_width
+        self.image_cache = OrderedDict()  # rendered images by frame and display settings (least recently used first)
 
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -81,6 +90,7 @@ class IVUSDisplay(QGraphicsView):
             for frame in range(num_frames)
         ]
         self.images = images
+        self.image_cache.clear()
         self.main_window.longitudinal_view.set_data(self.images, self.full_contours)
         self.display_image(update_image=True, update_contours=True, update_phase=True)
 
@@ -96,35 +106,9 @@ class IVUSDisplay(QGraphicsView):
             self.active_point = None
             self.active_point_index = None
 
-            # Calculate lower and upper bounds for the adjusted window level and window width
-            lower_bound = self.window_level - self.window_width / 2
-            upper_bound = self.window_level + self.window_width / 2
-
-            # Clip and normalize pixel values
-            normalised_data = np.clip(self.images[self.frame, :, :], lower_bound, upper_bound)
-            normalised_data = ((normalised_data - lower_bound) / (upper_bound - lower_bound) * 255).astype(np.uint8)
-            height, width = normalised_data.shape
-
-            if self.main_window.filter == 0:
-                normalised_data = cv2.medianBlur(normalised_data, 5)
-            elif self.main_window.filter == 1:
-                normalised_data = cv2.GaussianBlur(normalised_data, (5, 5), 0)
-            elif self.main_window.filter == 2:
-                normalised_data = cv2.bilateralFilter(normalised_data, 9, 75, 75)
-
-            if self.main_window.colormap_enabled:
-                # Apply an orange-blue colormap
-                colormap = cv2.applyColorMap(normalised_data, cv2.COLORMAP_COOL)
-                q_image = QImage(colormap.data, width, height, width * 3, QImage.Format.Format_RGB888).scaled(
-                    self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
-                )
-            else:
-                q_image = QImage(normalised_data.data, width, height, width, QImage.Format.Format_Grayscale8).scaled(
-                    self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
-                )
-
-            image = QGraphicsPixmapItem(QPixmap.fromImage(q_image))
+            image = QGraphicsPixmapItem(self.image_pixmap(self.frame))
             self.graphics_scene.addItem(image)
+            height = self.images.shape[1]
 
             self.main_window.longitudinal_view.update_marker(self.frame)
             marker = Marker(
@@ -293,6 +277,7 @@ class IVUSDisplay(QGraphicsView):
                         self.main_window.data['lumen'][1][self.frame] = [
                             point / self.scaling_factor for point in downsampled[1]
                         ]
+                        bump_contour_version(self.main_window.data, self.frame)
 
                     self.stop_contour()
                     return
@@ -307,6 +292,7 @@ class IVUSDisplay(QGraphicsView):
         self.points_to_draw = []
         self.main_window.data['lumen'][0][self.frame] = []
         self.main_window.data['lumen'][1][self.frame] = []
+        bump_contour_version(self.main_window.data, self.frame)
         self.display_image(update_contours=True)  # clear previous contour
 
     def stop_contour(self):
@@ -314,7 +300,7 @@ class IVUSDisplay(QGraphicsView):
             self.contour_mode = False
             self.main_window.setCursor(Qt.ArrowCursor)
             self.display_image(update_contours=True)
-            self.main_window.longitudinal_view.lview_contour(self.frame, self.full_contours[self.frame], update=True)
+            self.main_window.longitudinal_view.lview_contour(self.frame, self.full_contours[self.frame])
 
     def draw_measure(self):
         for index in range(2):
@@ -399,13 +385,58 @@ class IVUSDisplay(QGraphicsView):
         self.main_window.data['reference'][self.frame] = None
         self.display_image(update_contours=True)
 
+    def image_pixmap(self, frame):
+        """Windowed, filtered and scaled image of the frame, rendered images are cached for the current settings"""
+        key = (frame, self.window_level, self.window_width, self.main_window.filter, self.main_window.colormap_enabled)
+        if key in self.image_cache:
+            self.image_cache.move_to_end(key)
+            return self.image_cache[key]
+
+        # Calculate lower and upper bounds for the adjusted window level and window width
+        lower_bound = self.window_level - self.window_width / 2
+        upper_bound = self.window_level + self.window_width / 2
+
+        # Clip and normalize pixel values
+        normalised_data = np.clip(self.images[frame, :, :], lower_bound, upper_bound)
+        normalised_data = ((normalised_data - lower_bound) / (upper_bound - lower_bound) * 255).astype(np.uint8)
+        height, width = normalised_data.shape
+
+        if self.main_window.filter == 0:
+            normalised_data = cv2.medianBlur(normalised_data, 5)
+        elif self.main_window.filter == 1:
+            normalised_data = cv2.GaussianBlur(normalised_data, (5, 5), 0)
+        elif self.main_window.filter == 2:
+            normalised_data = cv2.bilateralFilter(normalised_data, 9, 75, 75)
+
+        if self.main_window.colormap_enabled:
+            # Apply an orange-blue colormap
+            colormap = cv2.applyColorMap(normalised_data, cv2.COLORMAP_COOL)
+            q_image = QImage(colormap.data, width, height, width * 3, QImage.Format.Format_RGB888).scaled(
+                self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+            )
+        else:
+            q_image = QImage(normalised_data.data, width, height, width, QImage.Format.Format_Grayscale8).scaled(
+                self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+            )
+
+        self.image_cache[key] = QPixmap.fromImage(q_image)
+        if len(self.image_cache) > IMAGE_CACHE_SIZE:
+            self.image_cache.popitem(last=False)
+
+        return self.image_cache[key]
+
+    def prefetch(self, frame):
+        """Renders the image of the frame in advance (e.g. the next frame during playback)"""
+        self.image_pixmap(frame)
+
     def update_display(self):
         self.display_image(update_image=True, update_contours=True, update_phase=True)
 
     def set_frame(self, value):
         self.frame = value
         self.current_contour = None
-        self.stop_contour()
+        if self.contour_mode:  # the new frame is displayed by update_display
+            self.stop_contour()
         if self.measure_index is not None:
             self.stop_measure(self.measure_index)
 
@@ -484,8 +515,7 @@ class IVUSDisplay(QGraphicsView):
                 self.main_window.data['lumen'][1][self.frame] = [
                     point / self.scaling_factor for point in self.current_contour.knot_points[1]
                 ]
+                bump_contour_version(self.main_window.data, self.frame)
                 self.display_image(update_contours=True)
-                self.main_window.longitudinal_view.lview_contour(
-                    self.frame, self.full_contours[self.frame], update=True
-                )
+                self.main_window.longitudinal_view.lview_contour(self.frame, self.full_contours[self.frame])
                 self.active_point_index = None
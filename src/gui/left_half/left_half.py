@@ -1,4 +1,3 @@
-import time
 import bisect
 
 from loguru import logger
@@ -6,10 +5,10 @@ from functools import partial
 from PyQt5.QtWidgets import (
     QPushButton,
     QStyle,
-    QApplication,
     QLabel,
     QWidget,
     QCheckBox,
+    QComboBox,
     QVBoxLayout,
     QHBoxLayout,
     QGridLayout,
@@ -17,6 +16,7 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt
 
 from gui.left_half.IVUS_display import IVUSDisplay
+from gui.left_half.playback import Playback, PLAYBACK_SPEEDS
 from gui.utils.slider import Slider, Communicate
 
 
@@ -48,7 +48,6 @@ class LeftHalf:
         self.play_button.setIcon(self.play_icon)
         self.play_button.setMaximumWidth(30)
         self.play_button.clicked.connect(partial(self.play, main_window))
-        self.paused = True
         main_window.display_slider = Slider(main_window, Qt.Horizontal)
         main_window.display_slider.valueChanged[int].connect(self.change_value)
         slider_hbox = QHBoxLayout()
@@ -59,9 +58,24 @@ class LeftHalf:
         self.frame_number_label = QLabel()
         self.frame_number_label.setAlignment(Qt.AlignCenter)
         self.frame_number_label.setText(f'Frame {main_window.display_slider.value() + 1}')
+        self.playback_label = QLabel()
+        self.playback = Playback(main_window, self.playback_label, partial(self.play_button.setIcon, self.play_icon))
         frame_num_hbox = QHBoxLayout()
         frame_num_hbox.addWidget(self.frame_number_label)
+        frame_num_hbox.addWidget(self.playback_label)
         left_lower_grid.addLayout(frame_num_hbox, 1, 1)
+
+        playback_hbox = QHBoxLayout()
+        speed_box = QComboBox()
+        speed_box.addItems([f'{speed:g}x' for speed in PLAYBACK_SPEEDS])
+        speed_box.setCurrentIndex(PLAYBACK_SPEEDS.index(1))
+        speed_box.currentIndexChanged[int].connect(lambda index: self.playback.set_speed(PLAYBACK_SPEEDS[index]))
+        gated_only_box = QCheckBox('Play gated frames only')
+        gated_only_box.stateChanged[int].connect(lambda state: self.playback.set_gated_only(bool(state)))
+        playback_hbox.addWidget(QLabel('Playback speed'))
+        playback_hbox.addWidget(speed_box)
+        playback_hbox.addWidget(gated_only_box)
+        left_lower_grid.addLayout(playback_hbox, 1, 0)
         left_vbox.addLayout(left_lower_grid)
         self.left_widget.setLayout(left_vbox)
 
@@ -69,26 +83,16 @@ class LeftHalf:
         return self.left_widget
 
     def play(self, main_window):
-        """Plays all frames until end of pullback starting from currently selected frame"""
+        """Plays (or pauses) all frames until end of pullback starting from currently selected frame"""
         if not main_window.image_displayed:
             return
 
-        start_frame = main_window.display_slider.value()
-        if self.paused:
-            self.paused = False
-            self.play_button.setIcon(self.pause_icon)
-        else:
-            self.paused = True
+        if self.playback.playing:
+            self.playback.stop()
             self.play_button.setIcon(self.play_icon)
-
-        for frame in range(start_frame, main_window.metadata['num_frames']):
-            if not self.paused:
-                main_window.display_slider.set_value(frame)
-                QApplication.processEvents()
-                time.sleep(0.05)
-                self.frame_number_label.setText(f'Frame {frame + 1}')
-
-        self.play_button.setIcon(self.play_icon)
+        else:
+            self.playback.start()
+            self.play_button.setIcon(self.pause_icon)
 
     def change_value(self, value):
         self.main_window.display_frame_comms.updateBW.emit(value)
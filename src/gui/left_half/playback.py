@@ -0,0 +1,119 @@
+import time
+import bisect
+from collections import deque
+
+from PyQt5.QtCore import Qt, QTimer
+
+PLAYBACK_SPEEDS = [0.25, 0.5, 1, 2, 4]
+READOUT_INTERVAL = 0.5  # in s
+
+
+class Playback:
+    """
+    Timer-driven playback at the frame rate of the pullback (times the selected speed).
+
+    The timer is scheduled for the time the next frame is due, each tick shows the frame that is due at the current
+    time, hence frames are dropped if rendering falls behind instead of slowing down the playback. With gated_only,
+    only the gated frames (main_window.gated_frames) are shown, each at the time it was acquired. The next frame is
+    prefetched into the render cache of the display if there is time left before it is due. The achieved fps, the
+    latency (time between a frame being due and displayed) and the number of dropped frames are shown in the readout
+    label.
+    """
+
+    def __init__(self, main_window, readout_label, on_finished):
+        self.main_window = main_window
+        self.readout_label = readout_label
+        self.on_finished = on_finished
+        self.speed = 1
+        self.gated_only = False
+        self.playing = False
+        self.timer = QTimer(main_window)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.display_times = deque()  # display times of the last second, for the fps readout
+        self.latencies = deque(maxlen=30)
+        self.last_readout = 0
+
+    def frame_rate(self):
+        return self.main_window.metadata.get('frame_rate', 30) * self.speed
+
+    def start(self):
+        """(Re-)starts the playback at the current frame"""
+        self.frames = sorted(self.main_window.gated_frames) if self.gated_only else None
+        self.start_frame = self.main_window.display_slider.value()
+        self.start_time = time.perf_counter()
+        self.shown_frame = self.start_frame
+        self.dropped_frames = 0
+        self.display_times.clear()
+        self.latencies.clear()
+        self.playing = True
+        self.timer.start(0)
+
+    def stop(self):
+        self.playing = False
+        self.timer.stop()
+
+    def set_speed(self, speed):
+        self.speed = speed
+        if self.playing:
+            self.start()
+
+    def set_gated_only(self, gated_only):
+        self.gated_only = gated_only
+        if self.playing:
+            self.start()
+
+    def due_time(self, frame):
+        return self.start_time + (frame - self.start_frame) / self.frame_rate()
+
+    def due_frame(self, now):
+        """Frame to display at the given time (None if no new frame is due yet) and the number of skipped frames"""
+        position = self.start_frame + int((now - self.start_time) * self.frame_rate())
+        position = min(position, self.main_window.metadata['num_frames'] - 1)
+        if self.frames is None:
+            return (position, position - self.shown_frame - 1) if position > self.shown_frame else (None, 0)
+        shown_index = bisect.bisect_right(self.frames, self.shown_frame)
+        due_index = bisect.bisect_right(self.frames, position) - 1
+        if due_index < shown_index:
+            return None, 0
+        return self.frames[due_index], due_index - shown_index
+
+    def next_frame(self, frame):
+        if self.frames is None:
+            return frame + 1 if frame + 1 < self.main_window.metadata['num_frames'] else None
+        index = bisect.bisect_right(self.frames, frame)
+        return self.frames[index] if index < len(self.frames) else None
+
+    def tick(self):
+        now = time.perf_counter()
+        frame, skipped_frames = self.due_frame(now)
+        if frame is not None:
+            self.dropped_frames += skipped_frames
+            self.main_window.display_slider.set_value(frame)
+            self.shown_frame = frame
+            now = time.perf_counter()
+            self.latencies.append(now - self.due_time(frame))
+            self.display_times.append(now)
+            while self.display_times[0] < now - 1:
+                self.display_times.popleft()
+            if now - self.last_readout > READOUT_INTERVAL:
+                self.update_readout()
+                self.last_readout = now
+
+        next_frame = self.next_frame(self.shown_frame)
+        if next_frame is None:  # end of pullback
+            self.stop()
+            self.update_readout()
+            self.on_finished()
+            return
+        if self.due_time(next_frame) > time.perf_counter():  # idle until the next frame is due
+            self.main_window.display.prefetch(next_frame)
+        self.timer.start(max(0, int((self.due_time(next_frame) - time.perf_counter()) * 1000)))
+
+    def update_readout(self):
+        fps = len(self.display_times) / min(1, time.perf_counter() - self.start_time) if self.display_times else 0
+        latency = sum(self.latencies) / len(self.latencies) * 1000 if self.latencies else 0
+        self.readout_label.setText(
+            f'{fps:.1f} fps ({self.speed:g}x), latency {latency:.0f} ms, {self.dropped_frames} dropped'
+        )
@@ -1,5 +1,5 @@
 from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QDialog, QLineEdit, QDialogButtonBox, QFormLayout
+from PyQt5.QtWidgets import QDialog, QLineEdit, QDialogButtonBox, QFormLayout, QCheckBox
 
 class FrameRangeDialog(QDialog):
     def __init__(self, main_window):
@@ -56,3 +56,31 @@ class StartFramesDialog(QDialog):
         diastolic = int(self.diastolic_start.text()) - 1
         systolic = int(self.systolic_start.text()) - 1
         return diastolic, systolic
+
+
+class VideoExportDialog(QDialog):
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.setWindowTitle('Save Video Pullback')
+
+        self.contours = QCheckBox(self)
+        self.contours.setChecked(True)
+        self.phase_labels = QCheckBox(self)
+        self.phase_labels.setChecked(True)
+        self.gated_only = QCheckBox(self)
+        self.gated_only.setEnabled(bool(main_window.gated_frames))
+
+        buttonBox = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+
+        layout = QFormLayout(self)
+        layout.addRow('Contour overlays', self.contours)
+        layout.addRow('Phase labels (D/S)', self.phase_labels)
+        layout.addRow('Gated frames only', self.gated_only)
+        layout.addWidget(buttonBox)
+
+        buttonBox.accepted.connect(self.accept)
+        buttonBox.rejected.connect(self.reject)
+
+    def getInputs(self):
+        return self.contours.isChecked(), self.phase_labels.isChecked(), self.gated_only.isChecked()
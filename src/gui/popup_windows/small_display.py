@@ -1,15 +1,30 @@
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
 from loguru import logger
 from PyQt5.QtWidgets import QMainWindow, QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsLineItem, QGraphicsTextItem
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QPixmap, QImage, QPen
-from shapely.geometry import Polygon
 
-from gui.utils.geometry import Spline, Point
-from report.report import farthest_points, closest_points
+from gui.utils.geometry import Spline, Point, interpolate_contour
+from gui.utils.helpers import lazy_import
 import numpy as np
 
+Polygon = lazy_import('shapely.geometry', 'Polygon')
+farthest_pair = lazy_import('report.report', 'farthest_pair')
+closest_pair = lazy_import('report.report', 'closest_pair')
+frame_similarity = lazy_import('gating.frame_similarity', 'frame_similarity')
+
 
 class SmallDisplay(QMainWindow):
+    """
+    Shows the next gated frame (image, contour and most similar previous frame) next to the main display.
+    Updates are computed in a worker thread: while one is computed, newer requests replace the waiting one (their
+    update flags are merged), so holding an arrow key only computes the latest frame instead of every step.
+    """
+
+    preview_ready = pyqtSignal(object)  # emitted from the worker thread with (request, future)
+
     def __init__(self, main_window):
         super().__init__(main_window)
         self.main_window = main_window
@@ -39,17 +54,21 @@ class SmallDisplay(QMainWindow):
         self.pixmap = QGraphicsPixmapItem()
         self.scene.addItem(self.pixmap)
 
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.computing = False
+        self.waiting_request = None  # latest request not yet submitted to the worker
+        self.requested_frame = None  # frame of the latest request, results for other frames are stale
+        self.shown_frame = None
+        self.shown_knot_points = None
+        self.preview_ready.connect(self.apply_preview)
+
     def calculate_correlation(self, frame):
         """Calculates correlation coefficients with the previous 20 to 10 frames."""
-        correlations = []
-        frame_indices = []
         start_frame = max(0, frame - 30)
         end_frame = max(0, frame - 5)
-        
-        for i in range(start_frame, end_frame):
-            corr = np.corrcoef(self.main_window.images[frame].ravel(), self.main_window.images[i].ravel())[0, 1]
-            correlations.append(corr)
-            frame_indices.append(i)
+        frame_indices = list(range(start_frame, end_frame))
+        # cached dot products of standardized frame vectors (kept on the main window, see gating.frame_similarity)
+        correlations = frame_similarity(self.main_window).similarity(frame, frame_indices).tolist()
 
         # If less than 10 frames, pad with 0s to maintain the length
         while len(correlations) < 10:
@@ -70,95 +89,146 @@ class SmallDisplay(QMainWindow):
         return best_frame_index, max_corr
 
     def update_frame(self, frame, update_image=False, update_contours=False, update_text=False):
+        """Schedules an update of the small display, only the latest request is computed and applied"""
+        self.requested_frame = frame
+        if frame is None:
+            self.waiting_request = None
+            self.shown_frame = None
+            self.pixmap.setPixmap(QPixmap())
+            self.setWindowTitle("No Frame to Display")
+            [self.scene.removeItem(item) for item in self.scene.items() if not isinstance(item, QGraphicsPixmapItem)]
+            return
+
+        lumen = self.main_window.data['lumen']
+        # state of the GUI at the time of the request, the worker must not read it later
+        knot_points = (
+            [list(lumen[0][frame]), list(lumen[1][frame])]
+            if lumen[0][frame] and not self.main_window.hide_contours
+            else None
+        )
+        if frame != self.shown_frame:  # a new frame needs everything
+            update_image, update_contours, update_text = True, True, True
+        elif knot_points == self.shown_knot_points:  # the image of a frame never changes, the contour did not either
+            update_image, update_contours = False, False
+        updates = [update_image, update_contours, update_text]
+        if self.waiting_request is not None:  # coalesce with the request that was not computed yet
+            updates = [new or old for new, old in zip(updates, self.waiting_request.updates)]
+        self.waiting_request = SimpleNamespace(
+            frame=frame,
+            updates=updates,
+            knot_points=knot_points,
+            current_frame=self.main_window.display.frame,
+            phase='Diastolic' if self.main_window.use_diastolic_button.isChecked() else 'Systolic',
+        )
+        self.submit()
+
+    def submit(self):
+        if self.computing or self.waiting_request is None:
+            return
+        request, self.waiting_request = self.waiting_request, None
+        self.computing = True
+        future = self.executor.submit(self.compute_preview, request)
+        future.add_done_callback(lambda future: self.preview_ready.emit((request, future)))
+
+    def compute_preview(self, request):
+        """Computes everything that is displayed for the request (worker thread, no access to the scene)"""
+        frame = request.frame
+        update_image, update_contours, update_text = request.updates
+        preview = SimpleNamespace(image=None, contour=None, text=None)
+
         if update_image:
+            image = self.main_window.images[frame]
+            q_image = QImage(image.data, image.shape[1], image.shape[0], image.shape[1], QImage.Format_Grayscale8)
+            preview.image = q_image.scaled(
+                self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+            )  # scaled copy, does not reference the image data
+
+        if update_contours and request.knot_points is not None:
+            knot_points = [[point * self.scaling_factor for point in points] for points in request.knot_points]
+            full_contour = interpolate_contour(knot_points, self.n_points_contour + 1)
+            if full_contour[0] is not None:
+                polygon = Polygon([(x, y) for x, y in zip(full_contour[0], full_contour[1])])
+                _, farthest = farthest_pair(polygon.exterior.coords)
+                _, closest = closest_pair(polygon.exterior.coords)
+                preview.contour = SimpleNamespace(
+                    knot_points=knot_points,
+                    centroid=(polygon.centroid.x, polygon.centroid.y),
+                    lines=[pair for pair in [farthest, closest] if pair is not None],
+                )
+
+        if update_text:
+            # Calculate correlation for this frame
+            correlations, frame_indices = self.calculate_correlation(frame)
+            best_frame_index, best_correlation = self.find_best_correlation(correlations, frame_indices)
 
-            if frame is None:
-                self.pixmap.setPixmap(QPixmap())
-                self.setWindowTitle("No Frame to Display")
-                [self.scene.removeItem(item) for item in self.scene.items() if not isinstance(item, QGraphicsPixmapItem)]
-                return
-            
-            self.pixmap.setPixmap(
-                QPixmap.fromImage(
-                    QImage(
-                        self.main_window.images[frame],
-                        self.main_window.images[frame].shape[1],
-                        self.main_window.images[frame].shape[0],
-                        self.main_window.images[frame].shape[1],
-                        QImage.Format_Grayscale8,
-                    ).scaled(self.image_size, self.image_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            if best_frame_index is not None:
+                distance = frame - request.current_frame
+                preview.text = (
+                    f"Frame {frame + 1} (+{distance})\n Correlation Frame: {best_frame_index} ({best_correlation:.2f})"
                 )
-            )
+            else:
+                preview.text = f"Frame {frame + 1} \n No Previous Frames Available"
+
+        return preview
+
+    def apply_preview(self, result):
+        """Applies a computed preview to the scene (GUI thread), stale previews of another frame are dropped"""
+        request, future = result
+        self.computing = False
+        if request.frame == self.requested_frame:  # a waiting request for the same frame only refreshes it
+            try:
+                self.show_preview(request, future.result())
+            except Exception as error:
+                logger.error(f'Small display could not be updated: {error}')
+        self.submit()
+
+    def show_preview(self, request, preview):
+        frame = request.frame
+        update_image, update_contours, update_text = request.updates
+        self.shown_frame = frame
+
+        if update_image:
+            self.pixmap.setPixmap(QPixmap.fromImage(preview.image))
 
         if update_contours:
+            self.shown_knot_points = request.knot_points
             contour_types = (Spline, Point, QGraphicsLineItem)  # types of items to remove from scene
             [self.scene.removeItem(item) for item in self.scene.items() if isinstance(item, contour_types)]
 
-            if self.main_window.data['lumen'][0][frame] and not self.main_window.hide_contours:
-                lumen_x = [point * self.scaling_factor for point in self.main_window.data['lumen'][0][frame]]
-                lumen_y = [point * self.scaling_factor for point in self.main_window.data['lumen'][1][frame]]
-                current_contour = Spline([lumen_x, lumen_y], self.n_points_contour, self.contour_thickness, 'green')
-
-                if current_contour.full_contour[0] is not None:
-                    self.contour_points = [
-                        Point(
-                            (current_contour.knot_points[0][i], current_contour.knot_points[1][i]),
-                            self.point_thickness,
-                            self.point_radius,
-                            'green',
-                        )
-                        for i in range(len(current_contour.knot_points[0]) - 1)
-                    ]
-                    [self.scene.addItem(point) for point in self.contour_points]
-                    self.scene.addItem(current_contour)
-                    polygon = Polygon(
-                        [(x, y) for x, y in zip(current_contour.full_contour[0], current_contour.full_contour[1])]
-                    )
-                    self.view.centerOn(polygon.centroid.x, polygon.centroid.y)
-                    _, farthest_x, farthest_y = farthest_points(self.main_window, polygon.exterior.coords, frame)
-                    _, closest_x, closest_y = closest_points(self.main_window, polygon, frame)
-                    self.scene.addLine(
-                        farthest_x[0],
-                        farthest_y[0],
-                        farthest_x[1],
-                        farthest_y[1],
-                        QPen(Qt.yellow, self.point_thickness * 2),
-                    )
-                    self.scene.addLine(
-                        closest_x[0],
-                        closest_y[0],
-                        closest_x[1],
-                        closest_y[1],
-                        QPen(Qt.yellow, self.point_thickness * 2),
+            if preview.contour is not None:
+                current_contour = Spline(
+                    preview.contour.knot_points, self.n_points_contour, self.contour_thickness, 'green'
+                )
+                self.contour_points = [
+                    Point(
+                        (current_contour.knot_points[0][i], current_contour.knot_points[1][i]),
+                        self.point_thickness,
+                        self.point_radius,
+                        'green',
                     )
+                    for i in range(len(current_contour.knot_points[0]) - 1)
+                ]
+                [self.scene.addItem(point) for point in self.contour_points]
+                self.scene.addItem(current_contour)
+                self.view.centerOn(*preview.contour.centroid)
+                for (x1, y1), (x2, y2) in preview.contour.lines:  # farthest and closest points
+                    self.scene.addLine(x1, y1, x2, y2, QPen(Qt.yellow, self.point_thickness * 2))
 
-        current_phase = 'Diastolic' if self.main_window.use_diastolic_button.isChecked() else 'Systolic'
-        self.setWindowTitle(f"Next {current_phase} Frame {frame + 1}")
+        self.setWindowTitle(f"Next {request.phase} Frame {frame + 1}")
 
         if update_text:
             # Remove previous correlation text items
             text_items = [item for item in self.scene.items() if isinstance(item, QGraphicsTextItem)]
             for item in text_items:
                 self.scene.removeItem(item)
-            
-            # Calculate correlation for this frame
-            correlations, frame_indices = self.calculate_correlation(frame)
-            best_frame_index, best_correlation = self.find_best_correlation(correlations, frame_indices)
-
-            # Update window title with correlation information
-            if best_frame_index is not None:
-                distance = frame - self.main_window.display.frame
-                text = f"Frame {frame + 1} (+{distance})\n Correlation Frame: {best_frame_index} ({best_correlation:.2f})"
-            else:
-                text = f"Frame {frame + 1} \n No Previous Frames Available"
 
             # Create and position the text item centered at the top of the view
-            text_item = self.scene.addText(text)
+            text_item = self.scene.addText(preview.text)
             text_item.setDefaultTextColor(Qt.white)
             font = text_item.font()
             font.setPointSize(font.pointSize() * 2)  # Double the font size
             text_item.setFont(font)
-            
+
             # Calculate centered position
             text_item_width = text_item.boundingRect().width()
             text_item_height = text_item.boundingRect().height()
@@ -0,0 +1,99 @@
+from loguru import logger
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDockWidget, QWidget, QFormLayout, QHBoxLayout, QSlider, QLabel, QPushButton
+
+# (config key, label, minimum, maximum, slider steps per unit)
+TUNING_PARAMETERS = [
+    ('lowcut', 'Lowcut (Hz)', 0.1, 5.0, 100),
+    ('highcut', 'Highcut (Hz)', 1.0, 15.0, 10),
+    ('order', 'Filter order', 1, 10, 1),
+    ('extrema_y_lim', 'Extrema y-limit (percentile)', 0, 100, 1),
+    ('extrema_x_lim', 'Extrema x-limit (frames)', 1, 30, 1),
+]
+
+
+class GatingTuning(QDockWidget):
+    """
+    Dockable panel to tune the filter and extrema parameters of the gating for the current case.
+    Every change only re-runs the filter, combination and extrema stages on the cached features and updates the
+    gating plot in place. Changes apply to the current session only (config.yaml is not modified).
+    """
+
+    def __init__(self, main_window):
+        super().__init__('Gating Parameters', main_window)
+        self.main_window = main_window
+        self.defaults = {key: main_window.config.gating[key] for key, *_ in TUNING_PARAMETERS}
+        self.sliders = {}
+        self.value_labels = {}
+
+        widget = QWidget()
+        layout = QFormLayout(widget)
+        for key, label, minimum, maximum, scale in TUNING_PARAMETERS:
+            slider = QSlider(Qt.Horizontal)
+            slider.setRange(round(minimum * scale), round(maximum * scale))
+            slider.setValue(round(self.defaults[key] * scale))
+            slider.valueChanged.connect(self.update_gating)
+            value_label = QLabel()
+            value_label.setMinimumWidth(40)
+            row = QHBoxLayout()
+            row.addWidget(slider)
+            row.addWidget(value_label)
+            layout.addRow(label, row)
+            self.sliders[key] = slider
+            self.value_labels[key] = value_label
+        self.update_labels()
+
+        buttons = QHBoxLayout()
+        apply_button = QPushButton('Apply Automatic Gating')
+        apply_button.setToolTip('Replace gated frames by automatic gating with the current parameters')
+        apply_button.clicked.connect(self.apply_automatic_gating)
+        reset_button = QPushButton('Reset')
+        reset_button.setToolTip('Reset parameters to the values from config.yaml')
+        reset_button.clicked.connect(self.reset)
+        buttons.addWidget(apply_button)
+        buttons.addWidget(reset_button)
+        layout.addRow(buttons)
+        self.setWidget(widget)
+
+    def values(self):
+        values = {}
+        for key, _, _, _, scale in TUNING_PARAMETERS:
+            value = self.sliders[key].value() / scale
+            values[key] = int(value) if scale == 1 else value
+        return values
+
+    def update_labels(self):
+        for key, value in self.values().items():
+            self.value_labels[key].setText(f'{value:g}')
+
+    def update_gating(self):
+        self.update_labels()
+        values = self.values()
+        nyquist = 0.5 * self.main_window.metadata.get('frame_rate', 30)
+        if not values['lowcut'] < values['highcut'] < nyquist:
+            self.main_window.status_bar.showMessage(
+                f'Lowcut must be smaller than highcut and highcut smaller than {nyquist:g} Hz (half the frame rate)'
+            )
+            return
+        for key, value in values.items():
+            self.main_window.config.gating[key] = value
+
+        if not self.main_window.gating_loaded:  # gating was not run yet
+            return
+        elapsed_ms = self.main_window.contour_based_gating.refilter()
+        if elapsed_ms is None:
+            return
+        logger.debug(f'Gating re-filtered in {elapsed_ms:.1f} ms')
+        self.main_window.status_bar.showMessage(f'Gating re-filtered in {elapsed_ms:.0f} ms')
+
+    def apply_automatic_gating(self):
+        if self.main_window.gating_loaded:
+            self.main_window.contour_based_gating.rerun_automatic_gating()
+            self.main_window.display.update_display()
+
+    def reset(self):
+        for key, _, _, _, scale in TUNING_PARAMETERS:
+            self.sliders[key].blockSignals(True)
+            self.sliders[key].setValue(round(self.defaults[key] * scale))
+            self.sliders[key].blockSignals(False)
+        self.update_gating()
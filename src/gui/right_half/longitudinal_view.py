@@ -1,114 +1,361 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from loguru import logger
-from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsLineItem
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap, QImage, QColor, QPen
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsLineItem, QGraphicsPathItem
+from PyQt5.QtCore import Qt, QPointF, pyqtSignal
+from PyQt5.QtGui import QPixmap, QImage, QColor, QPen, QPainterPath, QTransform
+
+from gui.utils.geometry import get_qt_pen
 
-from gui.utils.geometry import Point
+TILE_FRAMES = 512  # frames per tile, tiles are rendered at the level of detail of the current zoom
+MAX_LEVEL = 9  # coarsest level of detail (2**9 = 512 frames per pixel column)
+ZOOM_FACTOR = 1.25
 
 
 class LongitudinalView(QGraphicsView):
     """
     Displays the longitudinal view of the IVUS pullback.
+    The cut through the image center can be rotated (Ctrl + mouse wheel). Cuts at the angles in
+    config.display.lview_angles are precomputed and all cuts are cached, other angles are computed in a background
+    thread while the closest cached cut is shown.
+    The image is split into tiles of TILE_FRAMES frames, only the visible tiles are rendered, at a level of detail
+    matching the zoom along the frames (mouse wheel): at level n every pixel column averages 2**n frames and the
+    contour markers are aggregated per column.
     """
 
+    slice_ready = pyqtSignal(int, int, object)  # emitted from the background thread (data generation, angle, cut)
+
     def __init__(self, main_window):
         super().__init__()
         self.main_window = main_window
         self.image_size = main_window.config.display.image_size
+        self.precomputed_angles = list(main_window.config.display.get('lview_angles', [0]))
+        self.angle_step = main_window.config.display.get('lview_angle_step', 5)
         self.lview_contour_size = 2
         self.graphics_scene = QGraphicsScene()
+        self.angle = 0  # in degrees, 0 is a vertical cut (x = center) through the images
+        self.slices = {}  # cached longitudinal images per angle
+        self.pending_angles = set()
+        self.data_generation = 0  # discards cuts of previously loaded images
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.slice_ready.connect(self.add_slice)
+        self.images = None
+        self.contours = None
+        self.shown_angle = 0  # angle of the displayed cut (closest cached one while the current angle is computed)
+        self.level = 0  # level of detail of the current zoom
+        self.tiles = []  # (image item, upper marker item, lower marker item) per tile
+        self.tile_levels = []  # rendered level of detail per tile (None if not rendered)
+        self.marker_points = None  # upper and lower intersection of the contour with the cut per frame
+        self.show_markers = True
 
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.setScene(self.graphics_scene)
 
     def set_data(self, images, contours):
+        self.tiles, self.tile_levels = [], []  # items are deleted with the scene
         self.graphics_scene.clear()
+        self.resetTransform()
+        self.level = 0
+        self.images = images
+        self.contours = contours
         self.num_frames = images.shape[0]
-        self.points_on_marker = [None] * self.num_frames
         self.image_height = images.shape[1]
+        self.data_generation += 1
+        self.slices = {self.angle: oblique_slice(images, self.angle)}
+        self.pending_angles = set()
+
+        for angle in self.precomputed_angles:
+            self.request_slice(angle % 180)
+
+        self.graphics_scene.setSceneRect(0, 0, self.num_frames, self.image_height)  # tiles might not be rendered
+        marker_pen = get_qt_pen('green', self.lview_contour_size)
+        marker_pen.setCosmetic(True)  # same width at every zoom
+        tiles = []
+        for start in range(0, self.num_frames, TILE_FRAMES):
+            image_item = QGraphicsPixmapItem()
+            image_item.setPos(start, 0)
+            marker_items = [QGraphicsPathItem(), QGraphicsPathItem()]
+            for item in [image_item] + marker_items:
+                self.graphics_scene.addItem(item)
+            for item in marker_items:
+                item.setPen(marker_pen)
+                item.setVisible(self.show_markers)
+            tiles.append((image_item, *marker_items))
+        self.marker_points = self.contour_markers(contours)
+        self.tiles = tiles
+        self.show_slice(self.angle)
+
+    def show_slice(self, angle):
+        self.shown_angle = angle
+        self.tile_levels = [None] * len(self.tiles)
+        self.update_tiles()
+
+    def visible_tiles(self):
+        """Indices of the tiles in the viewport (and one on each side for smooth scrolling)"""
+        visible_rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        first_tile = max(0, int(visible_rect.left()) // TILE_FRAMES - 1)
+        last_tile = min(len(self.tiles) - 1, int(visible_rect.right()) // TILE_FRAMES + 1)
+
+        return range(first_tile, last_tile + 1)
 
-        slice = images[:, :, self.image_height // 2]
-        slice = np.transpose(slice, (1, 0)).copy()  # need .copy() to avoid QImage TypeError
+    def update_tiles(self):
+        """Renders the visible tiles at the current level of detail, frees all others"""
+        if self.images is None:
+            return
+        visible_tiles = self.visible_tiles()
+        for tile, (image_item, *marker_items) in enumerate(self.tiles):
+            if tile not in visible_tiles:
+                if self.tile_levels[tile] is not None:
+                    image_item.setPixmap(QPixmap())
+                    for item in marker_items:
+                        item.setPath(QPainterPath())
+                    self.tile_levels[tile] = None
+            elif self.tile_levels[tile] != self.level:
+                image_item.setPixmap(self.tile_pixmap(tile))
+                image_item.setTransform(QTransform.fromScale(2**self.level, 1))
+                self.draw_tile_markers(tile)
+                self.tile_levels[tile] = self.level
+
+    def tile_pixmap(self, tile):
+        start = tile * TILE_FRAMES
+        slice = downsample_columns(self.slices[self.shown_angle][:, start : start + TILE_FRAMES], 2**self.level)
         longitudinal_image = QImage(
-            slice.data, self.num_frames, self.image_height, self.num_frames, QImage.Format_Grayscale8
+            slice.data, slice.shape[1], self.image_height, slice.shape[1], QImage.Format_Grayscale8
         )
-        image = QGraphicsPixmapItem(QPixmap.fromImage(longitudinal_image))
-        self.graphics_scene.addItem(image)
+        return QPixmap.fromImage(longitudinal_image)
+
+    def draw_tile_markers(self, tile):
+        factor = 2**self.level
+        start = tile * TILE_FRAMES
+        # include the first column of the next tile to connect the lines across tiles
+        points = aggregate_markers(self.marker_points[start : start + TILE_FRAMES + factor], factor)
+        _, *marker_items = self.tiles[tile]
+        for item, side_points in zip(marker_items, points.T):
+            item.setPath(marker_path(side_points, self.lview_contour_size, factor, start))
+
+    def zoom(self, factor):
+        """Zooms along the frames, from the whole pullback fitting into the view to 4 pixels per frame"""
+        current_scale = self.transform().m11()
+        min_scale = min(1, self.viewport().width() / self.num_frames)
+        factor = np.clip(current_scale * factor, min_scale, 4) / current_scale
+        self.scale(factor, 1)
+        self.level = int(np.clip(np.floor(np.log2(1 / self.transform().m11())), 0, MAX_LEVEL))
+        self.update_tiles()
 
-        for frame, contour in enumerate(contours):
-            self.lview_contour(frame, contour)
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.update_tiles()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_tiles()
+
+    def request_slice(self, angle):
+        """Computes the cut at the given angle in the background thread (if not cached or already requested)"""
+        if angle in self.slices or angle in self.pending_angles:
+            return
+        self.pending_angles.add(angle)
+        data_generation = self.data_generation
+        future = self.executor.submit(oblique_slice, self.images, angle)
+        future.add_done_callback(lambda future: self.slice_ready.emit(data_generation, angle, future.result()))
+
+    def add_slice(self, data_generation, angle, slice):
+        if data_generation != self.data_generation:  # images changed in the meantime
+            return
+        self.slices[angle] = slice
+        self.pending_angles.discard(angle)
+        if angle == self.angle:
+            self.show_slice(angle)
+
+    def set_angle(self, angle):
+        """Rotates the cut, shows the closest cached cut until the requested one is computed"""
+        if self.images is None:
+            return
+        self.angle = angle % 180
+        self.marker_points = self.contour_markers(self.contours)
+        if self.angle in self.slices:
+            self.show_slice(self.angle)
+        else:
+            self.request_slice(self.angle)
+            closest_angle = min(
+                self.slices, key=lambda cached: min(abs(cached - self.angle), 180 - abs(cached - self.angle))
+            )
+            self.show_slice(closest_angle)
+        self.main_window.status_bar.showMessage(f'Longitudinal view at {self.angle}°')
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:  # rotate the cut
+            step = self.angle_step if event.angleDelta().y() > 0 else -self.angle_step
+            self.set_angle(self.angle + step)
+        elif self.images is not None:
+            self.zoom(ZOOM_FACTOR if event.angleDelta().y() > 0 else 1 / ZOOM_FACTOR)
+        event.accept()
 
     def update_marker(self, frame):
         [self.graphics_scene.removeItem(item) for item in self.graphics_scene.items() if isinstance(item, Marker)]
         marker = Marker(frame, 0, frame, self.image_height)
         self.graphics_scene.addItem(marker)
 
-    def lview_contour(self, frame, contour, update=False):
-        index = None
-        if self.points_on_marker[frame] is not None:  # remove previous points
-            for point in self.points_on_marker[frame]:
-                self.graphics_scene.removeItem(point)
+    def lview_contour(self, frame, contour):
+        """Updates the intersection of one (changed) contour with the cut, only redraws the affected tile(s)"""
+        self.marker_points[frame] = self.contour_markers([contour])[0]
+        self.redraw_markers(frame, frame + 1)
 
-        if contour is None:  # skip frames without contour (but still remove previous points)
-            return
-        else:
-            contour_x, contour_y = contour
-
-        if update or self.points_on_marker[frame] is None:  # need to find the two closest points to the marker
-            distances = contour_x - self.image_height // 2
-            num_points_to_collect = len(contour_x) // 10
-            point_indices = np.argpartition(np.abs(distances), num_points_to_collect)[:num_points_to_collect]
-            for i in range(len(point_indices)):
-                if (
-                    np.abs(contour_y[point_indices[0]] - contour_y[point_indices[i]])
-                    > self.image_height / 10
-                ):  # ensure the two points are from different sides of the contour
-                    index = i
-                    break
-            if index is None:  # no suitable points found
-                return
-            self.points_on_marker[frame] = (
-                Point(
-                    (frame, contour_y[point_indices[0]]),
-                    line_thickness=self.lview_contour_size,
-                    point_radius=self.lview_contour_size,
-                    color='green',
-                ),
-                Point(
-                    (frame, contour_y[point_indices[index]]),
-                    line_thickness=self.lview_contour_size,
-                    point_radius=self.lview_contour_size,
-                    color='green',
-                ),
-            )
-        for point in self.points_on_marker[frame]:
-            self.graphics_scene.addItem(point)
+    def redraw_markers(self, lower_limit, upper_limit):
+        first_tile = max(0, (lower_limit - 2**self.level) // TILE_FRAMES)  # previous tile connects to this one
+        last_tile = (upper_limit - 1) // TILE_FRAMES
+        for tile in range(first_tile, last_tile + 1):
+            if self.tile_levels[tile] is not None:  # tiles outside the view are drawn once they become visible
+                self.draw_tile_markers(tile)
+
+    def contour_markers(self, contours):
+        """Upper and lower intersection of all contours with the current cut (nan for frames without contour)"""
+        contour_x, contour_y = self.rotate_contour(stack_contours(contours))
+
+        return marker_intersections(contour_x, contour_y, self.image_height // 2, self.image_height / 10)
+
+    def rotate_contour(self, contour):
+        """Contour in coordinates of the current cut (cut at x = center, y along the cut)"""
+        if self.angle == 0:
+            return contour
+        center = self.image_height // 2
+        x = np.asarray(contour[0]) - center
+        y = np.asarray(contour[1]) - center
+        sin, cos = np.sin(np.radians(self.angle)), np.cos(np.radians(self.angle))
+
+        return x * cos - y * sin + center, x * sin + y * cos + center
 
     def hide_lview_contours(self):
-        [self.graphics_scene.removeItem(item) for item in self.graphics_scene.items() if isinstance(item, Point)]
+        self.set_markers_visible(False)
 
     def show_lview_contours(self):
-        for point in self.points_on_marker:
-            try:
-                self.graphics_scene.addItem(point[0])
-                self.graphics_scene.addItem(point[1])
-            except TypeError:
-                pass
+        self.set_markers_visible(True)
+
+    def set_markers_visible(self, visible):
+        self.show_markers = visible
+        for _, *marker_items in self.tiles:
+            for item in marker_items:
+                item.setVisible(visible)
 
     def remove_contours(self, lower_limit, upper_limit):
-        for frame in range(lower_limit, upper_limit):
-            if self.points_on_marker[frame] is not None:
-                for point in self.points_on_marker[frame]:
-                    self.graphics_scene.removeItem(point)
-                self.points_on_marker[frame] = None
+        self.marker_points[lower_limit:upper_limit] = np.nan
+        self.redraw_markers(lower_limit, upper_limit)
+
+
+def stack_contours(contours):
+    """
+    Closed contours of all frames as arrays (frames, points), shorter contours are padded with their closing point
+    and frames without contour are nan.
+    """
+    num_points = max((len(contour[0]) for contour in contours if contour is not None), default=0)
+    contour_x = np.full((len(contours), num_points + 1), np.nan)
+    contour_y = np.full((len(contours), num_points + 1), np.nan)
+    for frame, contour in enumerate(contours):
+        if contour is not None:
+            length = len(contour[0])
+            contour_x[frame, :length] = contour[0]
+            contour_y[frame, :length] = contour[1]
+            contour_x[frame, length:] = contour[0][0]  # close the contour
+            contour_y[frame, length:] = contour[1][0]
+
+    return contour_x, contour_y
+
+
+def marker_intersections(contour_x, contour_y, center, min_distance):
+    """
+    Intersections of the contour segments of all frames with the cut at x = center.
+    Returns an array (frames, 2) with the smallest and largest y of the crossings, nan if the contour does not cross
+    the cut on two sides at least min_distance apart.
+    """
+    right_side = contour_x > center  # nan (no contour) is never on the right side, hence never crosses
+    frames, segments = np.nonzero(right_side[:, :-1] != right_side[:, 1:])
+    start_x, end_x = contour_x[frames, segments], contour_x[frames, segments + 1]
+    start_y, end_y = contour_y[frames, segments], contour_y[frames, segments + 1]
+    crossing_y = start_y + (center - start_x) / (end_x - start_x) * (end_y - start_y)
+
+    upper = np.full(len(contour_x), np.inf)
+    lower = np.full(len(contour_x), -np.inf)
+    np.minimum.at(upper, frames, crossing_y)
+    np.maximum.at(lower, frames, crossing_y)
+    valid = lower - upper > min_distance
+
+    return np.where(valid[:, None], np.stack([upper, lower], axis=1), np.nan)
+
+
+def aggregate_markers(points, factor):
+    """Upper (smallest y) and lower (largest y) marker per group of factor frames, nan if no frame has a marker"""
+    if factor == 1:
+        return points
+    padded = np.full((-(-len(points) // factor) * factor, 2), np.nan)
+    padded[: len(points)] = points
+    padded = padded.reshape(-1, factor, 2)
+
+    return np.stack([np.fmin.reduce(padded[:, :, 0], axis=1), np.fmax.reduce(padded[:, :, 1], axis=1)], axis=1)
+
+
+def downsample_columns(slice, factor):
+    """Averages groups of factor columns (frames), returns contiguous uint8 data for QImage"""
+    if factor == 1:
+        return np.ascontiguousarray(slice)
+    height, width = slice.shape
+    padded = np.pad(slice, ((0, 0), (0, -width % factor)), mode='edge')
+
+    return np.ascontiguousarray(padded.reshape(height, -1, factor).mean(axis=2).astype(np.uint8))
+
+
+def marker_path(points, size, factor=1, offset=0):
+    """
+    One path through the points of consecutive columns (x = offset + column * factor, centered on the frames of the
+    column), isolated columns are drawn as dots
+    """
+    path = QPainterPath()
+    columns = np.flatnonzero(~np.isnan(points))
+    x = offset + columns * factor + (factor - 1) / 2
+    for run in np.split(np.arange(len(columns)), np.flatnonzero(np.diff(columns) > 1) + 1):
+        if len(run) == 1:
+            path.addEllipse(QPointF(x[run[0]], points[columns[run[0]]]), size / 2 * factor, size / 2)
+        elif len(run) > 1:
+            path.moveTo(x[run[0]], points[columns[run[0]]])
+            for index in run[1:]:
+                path.lineTo(x[index], points[columns[index]])
+
+    return path
+
+
+def oblique_slice(images, angle):
+    """
+    Longitudinal cut through the image centers at the given angle (degrees, 0 is the column at x = center),
+    bilinearly sampled for all frames at once. Returns an array (image height, frames) ready for QImage.
+    """
+    num_frames, height, width = images.shape
+    center = height // 2
+    t = np.arange(height) - center  # position along the cut
+    sin, cos = np.sin(np.radians(angle)), np.cos(np.radians(angle))
+    x = np.clip(center + t * sin, 0, width - 1)
+    y = np.clip(center + t * cos, 0, height - 1)
+    x0 = np.minimum(np.floor(x).astype(int), width - 2)
+    y0 = np.minimum(np.floor(y).astype(int), height - 2)
+    fx = (x - x0).astype(np.float32)
+    fy = (y - y0).astype(np.float32)
+
+    slice = (
+        images[:, y0, x0] * ((1 - fx) * (1 - fy))
+        + images[:, y0, x0 + 1] * (fx * (1 - fy))
+        + images[:, y0 + 1, x0] * ((1 - fx) * fy)
+        + images[:, y0 + 1, x0 + 1] * (fx * fy)
+    )
+
+    return np.ascontiguousarray(np.round(slice).astype(np.uint8).T)  # need contiguous data for QImage
 
 
 class Marker(QGraphicsLineItem):
     def __init__(self, x1, y1, x2, y2, color=Qt.white):
         super().__init__()
         pen = QPen(QColor(color), 1)
+        pen.setCosmetic(True)  # visible at every zoom
         pen.setDashPattern([1, 6])
         self.setLine(x1, y1, x2, y2)
         self.setPen(pen)
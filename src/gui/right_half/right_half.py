@@ -7,10 +7,13 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QSplitter, QPushButton, QCheckBox, QWidget
 
 from gui.right_half.gating_display import GatingDisplay
+from gui.right_half.gating_tuning import GatingTuning
 from gui.right_half.longitudinal_view import LongitudinalView
 from gui.popup_windows.small_display import SmallDisplay
 from gui.utils.contours_gui import new_measure, new_reference
-from segmentation.segment import segment
+from gui.utils.helpers import lazy_import
+
+segment = lazy_import('segmentation.segment', 'segment')
 
 
 class RightHalf:
@@ -38,6 +41,13 @@ class RightHalf:
         small_display_button.setToolTip('Open a small display to compare two frames')
         small_display_button.clicked.connect(partial(open_small_display, main_window))
         checkboxes.addWidget(small_display_button)
+        main_window.gating_tuning = GatingTuning(main_window)
+        main_window.addDockWidget(Qt.RightDockWidgetArea, main_window.gating_tuning)
+        main_window.gating_tuning.hide()
+        gating_tuning_button = QPushButton('Tune Gating')
+        gating_tuning_button.setToolTip('Open a panel to tune the filter and extrema parameters of the gating')
+        gating_tuning_button.clicked.connect(main_window.gating_tuning.show)
+        checkboxes.addWidget(gating_tuning_button)
         main_window.gating_display = GatingDisplay(main_window)
         checkboxes.addWidget(main_window.gating_display.toolbar)
         right_vbox.addLayout(checkboxes)
@@ -57,7 +67,7 @@ class RightHalf:
         segment_button.clicked.connect(partial(segment, main_window))
         gating_button = QPushButton('Extract Diastolic and Systolic Frames')
         gating_button.setToolTip('Extract diastolic and systolic images from pullback')
-        gating_button.clicked.connect(main_window.contour_based_gating)
+        gating_button.clicked.connect(main_window.run_gating)
         measure_button_1 = QPushButton('Measurement &1')
         measure_button_1.setToolTip('Measure distance between two points')
         measure_button_1.clicked.connect(partial(new_measure, main_window, index=0))
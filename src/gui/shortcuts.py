@@ -1,6 +1,4 @@
-import os
 import time
-import cv2
 import numpy as np
 
 from loguru import logger
@@ -10,18 +8,20 @@ from PyQt5.QtWidgets import QShortcut, QApplication
 from PyQt5.QtCore import Qt, QUrl
 
 from gui.popup_windows.frame_range_dialog import FrameRangeDialog
-from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
-from gui.popup_windows.video_player import VideoPlayer
+from gui.popup_windows.message_boxes import ErrorMessage
 from gui.utils.contours_gui import new_contour, new_measure
+from gui.utils.helpers import lazy_import
 from input_output.metadata import MetadataWindow
-from input_output.read_image import read_image
-from input_output.contours_io import write_contours, save_gated_images
-from segmentation.save_as_nifti import save_as_nifti
-from segmentation.segment import segment
-from report.report import report
+from input_output.contours_io import write_contours, save_gated_images, bump_contour_version
 
-
-from gui.popup_windows.results_plot import ResultsPlot
+# heavy dependencies (pydicom, SimpleITK, pandas, ...) are only imported when first needed
+read_image = lazy_import('input_output.read_image', 'read_image')
+save_as_nifti = lazy_import('segmentation.save_as_nifti', 'save_as_nifti')
+save_video_pullback = lazy_import('input_output.video_export', 'save_video_pullback')
+segment = lazy_import('segmentation.segment', 'segment')
+report = lazy_import('report.report', 'report')
+ResultsPlot = lazy_import('gui.popup_windows.results_plot', 'ResultsPlot')
+VideoPlayer = lazy_import('gui.popup_windows.video_player', 'VideoPlayer')
 
 
 def init_shortcuts(main_window):
@@ -95,7 +95,7 @@ def init_menu(main_window):
     filter_3.setShortcut('5')
 
     run_menu = main_window.menu_bar.addMenu('Run')
-    run_menu.addAction('Extract Diastolic and Systolic Frames', main_window.contour_based_gating)
+    run_menu.addAction('Extract Diastolic and Systolic Frames', main_window.run_gating)
     run_menu.addAction('Automatic Segmentation', partial(segment, main_window))
 
     metadata_menu = main_window.menu_bar.addMenu('Metadata')
@@ -134,6 +134,7 @@ def remove_contours(main_window):
             for frame in range(lower_limit, upper_limit):
                 main_window.data['lumen'][0][frame] = []
                 main_window.data['lumen'][1][frame] = []
+            bump_contour_version(main_window.data, range(lower_limit, upper_limit))
             main_window.longitudinal_view.remove_contours(lower_limit, upper_limit)
             main_window.display.update_display()
             main_window.status_bar.showMessage(main_window.waiting_status)
@@ -281,6 +282,7 @@ def delete_contour(main_window):
         main_window.tmp_lumen_y = main_window.data['lumen'][1][main_window.display.frame]
         main_window.data['lumen'][0][main_window.display.frame] = []
         main_window.data['lumen'][1][main_window.display.frame] = []
+        bump_contour_version(main_window.data, main_window.display.frame)
         main_window.display.display_image(update_contours=True)
 
 
@@ -288,6 +290,7 @@ def undo_delete(main_window):
     if main_window.image_displayed and main_window.tmp_lumen_x:
         main_window.data['lumen'][0][main_window.display.frame] = main_window.tmp_lumen_x
         main_window.data['lumen'][1][main_window.display.frame] = main_window.tmp_lumen_y
+        bump_contour_version(main_window.data, main_window.display.frame)
         main_window.tmp_lumen_x = []
         main_window.tmp_lumen_y = []
     main_window.display.stop_contour()
@@ -314,21 +317,3 @@ def plot_results(main_window):
             return
         results_plot = ResultsPlot(main_window, report_data)
         results_plot.show()
-
-
-def save_video_pullback(main_window):
-    if not main_window.image_displayed:
-        ErrorMessage(main_window, 'Cannot save video pullback before reading the image.')
-        return
-    main_window.status_bar.showMessage('Saving video pullback...')
-    image_stack = main_window.images
-    size = (image_stack[0].shape[1], image_stack[0].shape[0])
-    fps = main_window.metadata['frame_rate']
-    duration = len(image_stack) // fps
-    out_path = os.path.splitext(main_window.file_name)[0] + '_pullback.mp4'
-    out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (size[1], size[0]), False)
-    for frame in range(fps * duration):
-        out.write(image_stack[frame, :, :])
-    out.release()
-    SuccessMessage(main_window, f'Saving video')
-    main_window.status_bar.showMessage(main_window.waiting_status)
@@ -73,15 +73,7 @@ class Spline(QGraphicsPathItem):
 
     def interpolate(self, points):
         """Interpolates the spline points at n_points points along spline"""
-        points = np.array(points)
-        try:
-            tck, u = splprep(points, u=None, s=0.0, per=1)
-        except ValueError:
-            return (None, None)
-        u_new = np.linspace(u.min(), u.max(), self.n_points)
-        x_new, y_new = splev(u_new, tck, der=0)
-
-        return (x_new, y_new)
+        return interpolate_contour(points, self.n_points)
 
     def update(self, pos, index, path_index=None):
         """Updates the stored spline everytime it is moved
@@ -137,4 +129,17 @@ def get_qt_pen(color, thickness, transparency=255):
     pen_color = QColor(color)
     pen_color.setAlpha(transparency)
 
-    return QPen(pen_color, thickness)
\ No newline at end of file
+    return QPen(pen_color, thickness)
+
+
+def interpolate_contour(points, n_points):
+    """Closed spline through the knot points, sampled at n_points points (None, None if it cannot be interpolated)"""
+    points = np.array(points)
+    try:
+        tck, u = splprep(points, u=None, s=0.0, per=1)
+    except ValueError:
+        return (None, None)
+    u_new = np.linspace(u.min(), u.max(), n_points)
+    x_new, y_new = splev(u_new, tck, der=0)
+
+    return (x_new, y_new)
@@ -1,5 +1,21 @@
+import importlib
+
 from loguru import logger
 
+
+def lazy_import(module_name, attribute):
+    """
+    Returns a callable that imports module_name on first call and forwards to module_name.attribute.
+    Used to keep heavy dependencies (pandas, shapely, SimpleITK, ...) out of the application startup.
+    """
+
+    def wrapper(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), attribute)(*args, **kwargs)
+
+    wrapper.__name__ = attribute
+    return wrapper
+
+
 def connect_consecutive_frames(missing: list) -> str:
         nums = sorted(set(missing))
         connected = []
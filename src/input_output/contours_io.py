@@ -1,6 +1,7 @@
 import os
 import json
 import glob
+import numbers
 
 import numpy as np
 from loguru import logger
@@ -28,6 +29,8 @@ def read_contours(main_window, file_name=None):
             main_window.data['reference'] = [None] * main_window.metadata['num_frames']
         if 'gating_signal' not in main_window.data:  # added in version 0.7.4
             main_window.data['gating_signal'] = {}
+        if 'gating_features' not in main_window.data:  # added in version 0.7.5
+            main_window.data['gating_features'] = {}
         success = True
 
     elif xml_files:
@@ -55,6 +58,7 @@ def read_contours(main_window, file_name=None):
         success = True
 
     if success:
+        init_contour_versions(main_window.data, main_window.metadata['num_frames'])
         main_window.contours_drawn = True
         main_window.display.set_data(main_window.data['lumen'], main_window.images)
         main_window.hide_contours_box.setChecked(False)
@@ -97,6 +101,36 @@ def write_contours(main_window):
             json.dump(main_window.data, out_file)
 
 
+def init_contour_versions(data, num_frames):
+    """
+    Adds the per-frame contour versions to the data (missing in older or xml files). Every change of a frame's contour
+    bumps its contour_version, metrics_version holds the contour version the report metrics were computed for. Frames
+    with metrics in older files (lumen area and elliptic ratio non-zero) count as up to date.
+    """
+    if 'contour_version' not in data:  # added in version 0.7.5
+        data['contour_version'] = [0] * num_frames
+    if 'metrics_version' not in data:
+        elliptic_ratio = data.get('elliptic_ratio', [0] * num_frames)
+        data['metrics_version'] = [
+            0 if data['lumen_area'][frame] and elliptic_ratio[frame] != 0 else -1 for frame in range(num_frames)
+        ]
+
+
+def bump_contour_version(data, frames):
+    """Marks the contours of the frames (int or iterable) as changed, their report metrics are recomputed"""
+    for frame in [frames] if isinstance(frames, numbers.Integral) else frames:
+        data['contour_version'][frame] += 1
+
+
+def stale_frames(data, frames):
+    """Frames whose report metrics were not computed for their current contour"""
+    return [frame for frame in frames if data['metrics_version'][frame] != data['contour_version'][frame]]
+
+
+def mark_metrics_computed(data, frame):
+    data['metrics_version'][frame] = data['contour_version'][frame]
+
+
 def map_to_list(contours):
     """Converts map to list"""
     x, y = contours
@@ -107,24 +141,32 @@ def map_to_list(contours):
 
 
 def save_gated_images(main_window, file_name=None):
-    """Saves diastolic and systolic images as a 3D numpy array"""
+    """
+    Saves diastolic and systolic images as 3D numpy arrays (frames, height, width) together with the lumen masks
+    (*_masks.npy) and the frame indices in the pullback (*_frames.npy). The arrays are written directly into
+    memory-mapped .npy files, they can be loaded with np.load(..., mmap_mode='r') without reading them into memory.
+    """
     if not main_window.image_displayed:
         ErrorMessage(main_window, 'Cannot save gated images before reading the input file.')
         return
-
-    diastolic_images = []
-    systolic_images = []
-
-    for frame in range(main_window.metadata['num_frames']):
-        if main_window.data['phases'][frame] == 'D':
-            diastolic_images.append(main_window.images[frame])
-        elif main_window.data['phases'][frame] == 'S':
-            systolic_images.append(main_window.images[frame])
-
-    diastolic_images = np.array(diastolic_images)
-    systolic_images = np.array(systolic_images)
-
-    out_path_diastolic = os.path.splitext(main_window.file_name)[0] + '_diastolic.npy'
-    out_path_systolic = os.path.splitext(main_window.file_name)[0] + '_systolic.npy'
-    np.save(out_path_diastolic, diastolic_images)
-    np.save(out_path_systolic, systolic_images)
+    from segmentation.save_as_nifti import CHUNK_FRAMES, contours_to_mask  # heavy dependencies, imported when needed
+
+    base_path = os.path.splitext(main_window.file_name)[0]
+    for phase, name in [('D', 'diastolic'), ('S', 'systolic')]:
+        frames = np.flatnonzero(np.asarray(main_window.data['phases'][: main_window.metadata['num_frames']]) == phase)
+        shape = (len(frames), *main_window.images.shape[1:3])
+        images = np.lib.format.open_memmap(
+            f'{base_path}_{name}.npy', mode='w+', dtype=main_window.images.dtype, shape=shape
+        )
+        for start in range(0, len(frames), CHUNK_FRAMES):  # np.take(..., out=images) would buffer the whole stack
+            images[start : start + CHUNK_FRAMES] = main_window.images[frames[start : start + CHUNK_FRAMES]]
+        masks = np.lib.format.open_memmap(f'{base_path}_{name}_masks.npy', mode='w+', dtype=np.uint8, shape=shape)
+        contours = {
+            frame: main_window.display.full_contours[frame] if main_window.data['lumen'][0][frame] else None
+            for frame in frames
+        }
+        contours_to_mask(main_window.images, frames, contours, out=masks)
+        np.save(f'{base_path}_{name}_frames.npy', frames)
+        images.flush()
+        masks.flush()
+        del images, masks  # close the memory maps
@@ -9,7 +9,7 @@ from PyQt5.QtWidgets import QFileDialog
 
 from gui.popup_windows.message_boxes import ErrorMessage
 from input_output.metadata import parse_dicom
-from input_output.contours_io import read_contours
+from input_output.contours_io import read_contours, init_contour_versions
 
 
 def read_image(main_window):
@@ -89,6 +89,8 @@ def read_image(main_window):
             main_window.data['measure_lengths'] = [[np.nan, np.nan] for _ in range(main_window.metadata['num_frames'])]
             main_window.data['reference'] = [None] * main_window.metadata['num_frames']
             main_window.data['gating_signal'] = {}
+            main_window.data['gating_features'] = {}
+            init_contour_versions(main_window.data, main_window.metadata['num_frames'])
             main_window.display.set_data(main_window.data['lumen'], main_window.images)
 
         main_window.image_displayed = True
@@ -0,0 +1,194 @@
+import os
+import queue
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from loguru import logger
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import QProgressDialog
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
+
+from gui.popup_windows.frame_range_dialog import VideoExportDialog
+from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
+
+QUEUE_SIZE = 16  # rendered frames waiting for the encoder, bounds the memory if encoding falls behind
+
+
+def save_video_pullback(main_window):
+    if not main_window.image_displayed:
+        ErrorMessage(main_window, 'Cannot save video pullback before reading the image.')
+        return
+    if getattr(main_window, 'video_export', None) is not None:
+        ErrorMessage(main_window, 'Video pullback is still being saved.')
+        return
+    dialog = VideoExportDialog(main_window)
+    if not dialog.exec_():
+        return
+    draw_contours, draw_phases, gated_only = dialog.getInputs()
+
+    main_window.status_bar.showMessage('Saving video pullback...')
+    num_frames = main_window.metadata['num_frames']
+    frames = sorted(main_window.gated_frames) if gated_only else list(range(num_frames))
+    export = VideoExport(
+        main_window.images,
+        frames,
+        os.path.splitext(main_window.file_name)[0] + ('_gated' if gated_only else '') + '_pullback.mp4',
+        main_window.metadata['frame_rate'],
+        contours=(
+            {  # snapshot, contours are replaced (not modified) when edited during the export
+                frame: main_window.display.full_contours[frame] if main_window.data['lumen'][0][frame] else None
+                for frame in frames
+            }
+            if draw_contours
+            else None
+        ),
+        phases=list(main_window.data['phases']) if draw_phases else None,
+        contour_color=QColor(main_window.config.display.color_contour).getRgb()[:3],
+        phase_colors={'D': main_window.diastole_color, 'S': main_window.systole_color},
+    )
+
+    progress = QProgressDialog()
+    progress.setWindowFlags(Qt.Dialog)
+    progress.setMinimum(0)
+    progress.setMaximum(len(frames))
+    progress.resize(500, 100)
+    progress.setWindowTitle('Saving video pullback...')
+    progress.canceled.connect(export.cancel)
+    export.signals.progress.connect(progress.setValue)
+    export.signals.finished.connect(partial(finish_export, main_window, export, progress))
+    progress.show()
+
+    main_window.video_export = export
+    export.start()
+
+
+def finish_export(main_window, export, progress, future):
+    progress.close()
+    main_window.video_export = None
+    main_window.status_bar.showMessage(main_window.waiting_status)
+    try:
+        canceled = future.result()
+    except Exception as e:
+        logger.exception(e)
+        ErrorMessage(main_window, f'Could not save video pullback: {e}')
+        return
+    if not canceled:
+        logger.info(f'Video pullback saved to {export.out_path}')
+        SuccessMessage(main_window, 'Saving video')
+
+
+class VideoExportSignals(QObject):
+    progress = pyqtSignal(int)  # number of encoded frames
+    finished = pyqtSignal(object)  # future of the export, returns whether the export was canceled
+
+
+class VideoExport:
+    """
+    Saves the frames as video in a background thread. Frames are rendered (with optional contour overlays and phase
+    labels) by a pool of workers and passed in order to the encoder through a bounded queue. The video always has the
+    frame rate of the pullback: with gated frames only, each frame is shown until the next gated frame was acquired,
+    hence the video has the duration of the pullback.
+    """
+
+    def __init__(
+        self, images, frames, out_path, frame_rate, contours=None, phases=None, contour_color=None, phase_colors=None
+    ):
+        self.images = images
+        self.frames = frames
+        self.out_path = out_path
+        self.frame_rate = frame_rate
+        self.contours = contours  # contour (or None) by frame, None to export without contours
+        self.phases = phases  # phase by frame, None to export without phase labels
+        self.contour_color = contour_color
+        self.phase_colors = phase_colors
+        self.signals = VideoExportSignals()
+        self.canceled = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.error = None
+
+    def start(self):
+        future = self.executor.submit(self.run)
+        future.add_done_callback(self.signals.finished.emit)
+        self.executor.shutdown(wait=False)
+
+    def cancel(self):
+        self.canceled.set()
+
+    def run(self):
+        is_color = self.contours is not None or self.phases is not None
+        height, width = self.images.shape[1:3]
+        writer = cv2.VideoWriter(
+            self.out_path, cv2.VideoWriter_fourcc(*'mp4v'), self.frame_rate, (width, height), is_color
+        )
+        if not writer.isOpened():
+            raise OSError(f'Could not open video writer for {self.out_path}')
+        # each frame is repeated until the next frame is due (all 1 unless only gated frames are exported)
+        repeats = np.diff(self.frames, append=self.frames[-1] + 1) if self.frames else []
+        rendered = queue.Queue(maxsize=QUEUE_SIZE)  # futures of the rendered frames in frame order
+        encoder = threading.Thread(target=self.encode, args=(writer, rendered, repeats))
+        with ThreadPoolExecutor() as pool:
+            encoder.start()
+            for frame in self.frames:
+                if self.canceled.is_set():
+                    break
+                rendered.put(pool.submit(self.render, frame))  # blocks while the encoder is behind
+            rendered.put(None)
+            encoder.join()
+        writer.release()
+
+        if self.error is not None:
+            os.remove(self.out_path)
+            raise self.error
+        if self.canceled.is_set():
+            os.remove(self.out_path)  # incomplete video
+            return True
+
+        return False
+
+    def encode(self, writer, rendered, repeats):
+        """Writes the rendered frames in order, runs until None is received (frames are discarded after errors)"""
+        for i in range(len(repeats) + 1):
+            future = rendered.get()
+            if future is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                image = future.result()
+                for _ in range(repeats[i]):
+                    writer.write(image)
+            except Exception as e:
+                self.error = e
+                self.canceled.set()
+                continue
+            self.signals.progress.emit(i + 1)
+
+    def render(self, frame):
+        """Frame as grayscale image or with the contour and phase label drawn as color image"""
+        image = self.images[frame]
+        if self.contours is None and self.phases is None:
+            return np.ascontiguousarray(image, dtype=np.uint8)
+        image = cv2.cvtColor(np.ascontiguousarray(image, dtype=np.uint8), cv2.COLOR_GRAY2BGR)
+        thickness = max(1, round(min(image.shape[:2]) / 250))
+        if self.contours is not None and self.contours[frame] is not None:
+            points = np.stack([self.contours[frame][0], self.contours[frame][1]], axis=1)
+            cv2.polylines(
+                image, [np.round(points).astype(np.int32)], True, self.contour_color[::-1], thickness, cv2.LINE_AA
+            )
+        if self.phases is not None and self.phases[frame] in self.phase_colors:
+            font_scale = min(image.shape[:2]) / 250
+            cv2.putText(
+                image,
+                self.phases[frame],
+                (thickness * 5, round(30 * font_scale)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                font_scale,
+                self.phase_colors[self.phases[frame]][::-1],  # BGR
+                2 * thickness,
+                cv2.LINE_AA,
+            )
+
+        return image
@@ -1,6 +1,5 @@
 import os
 import math
-import csv
 
 import numpy as np
 import pandas as pd
@@ -9,9 +8,9 @@ from loguru import logger
 from PyQt5.QtWidgets import QProgressDialog
 from PyQt5.QtCore import Qt
 from shapely.geometry import Polygon
-from itertools import combinations
 
 from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
+from input_output.contours_io import init_contour_versions, stale_frames, mark_metrics_computed
 
 
 def report(main_window, lower_limit=None, upper_limit=None, suppress_messages=False):
@@ -54,19 +53,24 @@ def report(main_window, lower_limit=None, upper_limit=None, suppress_messages=Fa
         )
 
         if not suppress_messages:
-            SuccessMessage(main_window, 'Write report')
+            SuccessMessage(main_window, f'Write report ({report_data.attrs["recomputed_frames"]} frames recomputed)')
 
     return report_data
 
 
 def compute_all(main_window, contoured_frames, suppress_messages, plot=True, save_as_csv=True):
-    """compute all metrics and plot if desired"""
+    """
+    compute all metrics and plot if desired, metrics are only recomputed for frames whose contour changed since they
+    were last computed (number of recomputed frames in report_data.attrs['recomputed_frames'])
+    """
+    init_contour_versions(main_window.data, main_window.metadata['num_frames'])
+    frames_to_compute = stale_frames(main_window.data, contoured_frames)
     if not suppress_messages:
         progress = QProgressDialog(main_window)
         progress.setWindowFlags(Qt.Dialog)
         progress.setModal(True)
         progress.setMinimum(0)
-        progress.setMaximum(len(contoured_frames))
+        progress.setMaximum(len(frames_to_compute))
         progress.resize(500, 100)
         progress.setValue(0)
         progress.setWindowTitle('Writing report...')
@@ -93,10 +97,7 @@ def compute_all(main_window, contoured_frames, suppress_messages, plot=True, sav
     lumen_x = [contour[0] if contour is not None else None for contour in main_window.display.full_contours]
     lumen_y = [contour[1] if contour is not None else None for contour in main_window.display.full_contours]
 
-    for frame in contoured_frames:
-        if lumen_area[frame] and elliptic_ratio[frame] != 0:  # values already computed for this frame -> skip
-            continue
-
+    for index, frame in enumerate(frames_to_compute):
         polygon = Polygon([(x, y) for x, y in zip(lumen_x[frame], lumen_y[frame])])
         exterior_coords = polygon.exterior.coords
 
@@ -112,12 +113,15 @@ def compute_all(main_window, contoured_frames, suppress_messages, plot=True, sav
         vector_length[frame], vector_angle[frame] = centroid_center_vector(
             main_window, centroid_x[frame], centroid_y[frame]
         )
+        mark_metrics_computed(main_window.data, frame)
         if not suppress_messages:
-            progress.setValue(frame)
+            progress.setValue(index + 1)
             if progress.wasCanceled():
                 return None
+    logger.info(f'Report: recomputed metrics of {len(frames_to_compute)} of {len(contoured_frames)} contoured frames')
 
     report_data = pd.DataFrame()
+    report_data.attrs['recomputed_frames'] = len(frames_to_compute)
     report_data['frame'] = [
         frame + 1 for frame in contoured_frames
     ]  # want 1-based indexing for direct comparison with GUI
@@ -255,16 +259,22 @@ def centroid_center_vector(window, centroid_x, centroid_y):
     return vector_length, vector_angle
 
 
-def farthest_points(main_window, exterior_coords, frame):
-    max_distance = 0
-    farthest_points = None
+def farthest_pair(exterior_coords):
+    """Distance and pair of the two contour points farthest apart (first pair in the order of combinations)"""
+    coords = np.asarray(exterior_coords, dtype=float)
+    squared_distances = np.subtract.outer(coords[:, 0], coords[:, 0])
+    squared_distances *= squared_distances  # in place, avoids temporary (num_points x num_points) arrays
+    difference_y = np.subtract.outer(coords[:, 1], coords[:, 1])
+    squared_distances += difference_y * difference_y
+    squared_distances = np.triu(squared_distances, k=1)  # only pairs i < j (in the order of combinations)
+    index_1, index_2 = np.unravel_index(np.argmax(squared_distances), squared_distances.shape)  # first maximum
+    farthest_points = (tuple(coords[index_1]), tuple(coords[index_2]))
+
+    return math.dist(*farthest_points), farthest_points
 
-    for point1, point2 in combinations(exterior_coords, 2):
-        distance = math.dist(point1, point2)
-        if distance > max_distance:
-            max_distance = distance
-            farthest_points = (point1, point2)
 
+def farthest_points(main_window, exterior_coords, frame):
+    max_distance, farthest_points = farthest_pair(exterior_coords)
     longest_distance = max_distance * main_window.metadata['resolution']
 
     # Separate x and y coordinates and append to the respective lists
@@ -280,8 +290,8 @@ def farthest_points(main_window, exterior_coords, frame):
     return longest_distance, farthest_point_x, farthest_point_y
 
 
-def closest_points(main_window, polygon, frame):
-    contour = polygon.exterior.coords
+def closest_pair(contour):
+    """Distance and pair of the closest opposite contour points (pair is None if not found)"""
     num_points = len(contour)
     min_distance = math.inf
     closest_points = None
@@ -301,6 +311,11 @@ def closest_points(main_window, polygon, frame):
         if index_1 >= num_points // 2:
             break
 
+    return min_distance, closest_points
+
+
+def closest_points(main_window, polygon, frame):
+    min_distance, closest_points = closest_pair(polygon.exterior.coords)
     shortest_distance = min_distance * main_window.metadata['resolution']
 
     # Separate x and y coordinates and append to the respective lists
@@ -323,36 +338,56 @@ def closest_points(main_window, polygon, frame):
 
 
 def save_csv_files(main_window, lumen_x, lumen_y, name, frames):
+    """
+    Writes the contour points and reference points of the frames as tab-separated rows (frame, x, y, position) in mm,
+    y is mirrored over the x-axis. The columns of all rows are computed at once and the rows are streamed to the file.
+    With report.binary_format ('parquet' or 'feather'), the contours are also written in that format (requires pyarrow).
+    """
     if not frames:
         logger.warning(f'No frames available for {name} contours, skipping CSV saving.')
         return
     csv_out_dir = os.path.join(main_window.file_name + '_csv_files')
     logger.info(f'Saving {name} contours to {csv_out_dir}')
     os.makedirs(csv_out_dir, exist_ok=True)
+    resolution = main_window.metadata['resolution']
     # Get the image dimensions in mm needed to mirror over x-axis
-    img_dim_mm = main_window.metadata['dimension'] * main_window.metadata['resolution']
-
-    with open(os.path.join(csv_out_dir, f'{name}_contours.csv'), 'w', newline='') as contours_file:
-        contours_writer = csv.writer(contours_file, delimiter='\t')
-        with open(os.path.join(csv_out_dir, f'{name}_reference_points.csv'), 'w', newline='') as reference_file:
-            reference_writer = csv.writer(reference_file, delimiter='\t')
-            distance_offset = main_window.metadata['pullback_length'][frames[0]]
-            for frame in frames:
-                if lumen_x[frame] is None:  # no contour drawn for this frame
-                    continue
-                rows = zip(
-                    [x * main_window.metadata['resolution'] for x in lumen_x[frame]],
-                    [abs(y * main_window.metadata['resolution'] - img_dim_mm) for y in lumen_y[frame]],
-                )  # csv can only write rows, not columns directly
-                for row in rows:
-                    row = [frame + 1] + list(row) + [main_window.metadata['pullback_length'][frame] - distance_offset]
-                    contours_writer.writerow(row)
-                if main_window.data['reference'][frame] is not None:
-                    reference_writer.writerow(
-                        [
-                            frame + 1,
-                            main_window.data['reference'][frame][0] * main_window.metadata['resolution'],
-                            abs(main_window.data['reference'][frame][1] * main_window.metadata['resolution'] - img_dim_mm),
-                            main_window.metadata['pullback_length'][frame] - distance_offset,
-                        ]
-                    )
\ No newline at end of file
+    img_dim_mm = main_window.metadata['dimension'] * resolution
+    pullback_length = np.asarray(main_window.metadata['pullback_length'])
+    positions = pullback_length - pullback_length[frames[0]]
+
+    contoured_frames = np.array([frame for frame in frames if lumen_x[frame] is not None], dtype=int)
+    num_points = [len(lumen_x[frame]) for frame in contoured_frames]
+    contours = {
+        'frame': np.repeat(contoured_frames + 1, num_points),
+        'x_mm': np.concatenate([np.empty(0)] + [lumen_x[frame] for frame in contoured_frames]) * resolution,
+        'y_mm': np.abs(
+            np.concatenate([np.empty(0)] + [lumen_y[frame] for frame in contoured_frames]) * resolution - img_dim_mm
+        ),
+        'position': np.repeat(positions[contoured_frames], num_points),
+    }
+    reference_frames = np.array(
+        [frame for frame in contoured_frames if main_window.data['reference'][frame] is not None], dtype=int
+    )
+    reference_points = np.array(
+        [main_window.data['reference'][frame][:2] for frame in reference_frames], dtype=float
+    ).reshape(-1, 2)
+    references = {
+        'frame': reference_frames + 1,
+        'x_mm': reference_points[:, 0] * resolution,
+        'y_mm': np.abs(reference_points[:, 1] * resolution - img_dim_mm),
+        'position': positions[reference_frames],
+    }
+    for columns, file_name in [(contours, f'{name}_contours'), (references, f'{name}_reference_points')]:
+        with open(os.path.join(csv_out_dir, f'{file_name}.csv'), 'w', newline='') as out_file:
+            # same formatting as csv.writer (repr of the floats), rows are formatted while writing
+            row_format = '{}\t{!r}\t{!r}\t{!r}\r\n'.format
+            out_file.writelines(map(row_format, *(column.tolist() for column in columns.values())))
+
+    binary_format = main_window.config.report.get('binary_format', 'none')
+    if binary_format in ['parquet', 'feather']:
+        try:
+            getattr(pd.DataFrame(contours), f'to_{binary_format}')(
+                os.path.join(csv_out_dir, f'{name}_contours.{binary_format}')
+            )
+        except ImportError as e:
+            logger.warning(f'Could not save {name} contours as {binary_format}: {e}')
@@ -0,0 +1,66 @@
+import os
+import glob
+import time
+import hydra
+
+import SimpleITK as sitk
+import numpy as np
+from omegaconf import DictConfig
+from loguru import logger
+
+from segmentation.predict import Predict, NNUNET_PRESETS, nnunet_settings, dice_score
+
+
+def read_held_out_set(benchmark_dir):
+    """Reads image/label pairs in nnU-Net naming (imagesTs/<case>_0000.nii.gz, labelsTs/<case>.nii.gz)"""
+    cases = []
+    for image_file in sorted(glob.glob(os.path.join(benchmark_dir, 'imagesTs', '*.nii.gz'))):
+        case_name = os.path.basename(image_file).replace('_0000.nii.gz', '.nii.gz')
+        label_file = os.path.join(benchmark_dir, 'labelsTs', case_name)
+        if not os.path.isfile(label_file):
+            logger.warning(f'No label found for {image_file}, skipping')
+            continue
+        image = sitk.GetArrayFromImage(sitk.ReadImage(image_file))
+        label = sitk.GetArrayFromImage(sitk.ReadImage(label_file))
+        if image.ndim == 2:  # single frame
+            image = image[None, ...]
+            label = label[None, ...]
+        cases.append((case_name, image, label))
+
+    return cases
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def benchmark_nnunet(config: DictConfig) -> None:
+    """Reports frames/s and dice on a held-out set for every nnU-Net inference preset"""
+    cases = read_held_out_set(config.segmentation.benchmark_dir)
+    if not cases:
+        logger.error(f'No cases found in {config.segmentation.benchmark_dir}')
+        return
+    logger.info(f'Found {len(cases)} held-out cases')
+    predictor = Predict(main_window=None, config=config)
+
+    results = {}
+    for preset in NNUNET_PRESETS:
+        predictor.nnunet_settings = nnunet_settings(config, preset)
+        _, warmup_image, _ = cases[0]
+        predictor(warmup_image[:1], 0, 1)  # loads checkpoint, excluded from timing
+
+        num_frames = 0
+        inference_time = 0
+        dice = []
+        for case_name, image, label in cases:
+            start_time = time.time()
+            mask = predictor(image, 0, image.shape[0])
+            inference_time += time.time() - start_time
+            num_frames += image.shape[0]
+            dice.append(dice_score(label, mask))
+        results[preset] = (num_frames / inference_time, np.mean(dice), np.std(dice))
+
+    logger.info(f'{"preset":<10}{"frames/s":>10}{"dice":>16}')
+    for preset, (fps, dice_mean, dice_std) in results.items():
+        logger.info(f'{preset:<10}{fps:>10.2f}{dice_mean:>10.3f} ± {dice_std:.3f}')
+
+
+if __name__ == '__main__':
+    benchmark_nnunet()
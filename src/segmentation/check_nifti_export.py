@@ -0,0 +1,78 @@
+"""
+Regression check for the NIfTI export (NiftiExport): runs back-to-back exports of synthetic frames into a temporary
+directory and checks that unchanged files are skipped, changed contours are written again and that exports without
+2D files (save_2d: False) do not fail. Fails (exit code 1) if a check fails:
+
+    python3 -m segmentation.check_nifti_export --frames 100
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from segmentation.save_as_nifti import NiftiExport
+
+
+def circle(center, radius, num_points=100):
+    angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    return [center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)]
+
+
+def export(images, contours, out_path, save_2d, save_3d):
+    config = OmegaConf.create({'save_2d': save_2d, 'save_3d': save_3d, 'nifti_compression': 1})
+    save_seg_3d = any(contour is not None for contour in contours.values())
+    nifti_export = NiftiExport(images, contours, save_seg_3d, out_path, 'case', config)
+    canceled = nifti_export.run()
+
+    return canceled, nifti_export.written_files, nifti_export.skipped_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=100, help='number of frames (more than one chunk)')
+    parser.add_argument('--size', type=int, default=64, help='image width and height')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(args.frames, args.size, args.size), dtype=np.uint8)
+    center = (args.size / 2, args.size / 2)
+    contoured = {frame: circle(center, args.size / 4) for frame in range(args.frames)}
+    # 'all' mode, frames without contour are exported with empty masks
+    partially_contoured = {frame: contoured[frame] if frame % 3 else None for frame in range(args.frames)}
+
+    failed = False
+    for name, contours in [('contoured', contoured), ('all', partially_contoured)]:
+        for save_2d, save_3d in [(False, True), (True, False), (True, True)]:
+            num_2d = 2 * args.frames - sum(contour is None for contour in contours.values()) if save_2d else 0
+            num_3d = 2 if save_3d else 0
+            with tempfile.TemporaryDirectory() as out_path:
+                try:
+                    first = export(images, contours, out_path, save_2d, save_3d)
+                    second = export(images, contours, out_path, save_2d, save_3d)
+                    changed = {**contours, 1: circle(center, args.size / 8)}
+                    third = export(images, changed, out_path, save_2d, save_3d)
+                except Exception as e:
+                    print(f'{name}, save_2d={save_2d}, save_3d={save_3d}: export failed ({e!r})')
+                    failed = True
+                    continue
+                files = len([file for file in os.listdir(out_path) if '.nii' in file])
+            num_changed = (1 if save_2d else 0) + (1 if save_3d else 0)  # 2D mask of frame 1 and the 3D mask
+            expected = [
+                (False, num_2d + num_3d, 0),  # first export writes all files
+                (False, 0, num_2d + num_3d),  # unchanged files are skipped
+                (False, num_changed, num_2d + num_3d - num_changed),  # only files with changed contours are written
+            ]
+            results = [first, second, third]
+            status = 'ok' if results == expected and files == num_2d + num_3d else 'FAILED'
+            print(f'{name:>10}, save_2d={save_2d!s:>5}, save_3d={save_3d!s:>5}: {results} {status}')
+            failed |= status != 'ok'
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,41 @@ from loguru import logger
 from PyQt5.QtWidgets import QProgressDialog
 from PyQt5.QtCore import Qt
 from gui.popup_windows.message_boxes import ErrorMessage
+from gating.signal_processing import standardize_frames
 import gc
 
+NNUNET_PRESETS = {
+    'fast': dict(tile_step_size=1.0, use_gaussian=False, use_mirroring=False),
+    'balanced': dict(tile_step_size=0.5, use_gaussian=True, use_mirroring=False),
+    'accurate': dict(tile_step_size=0.5, use_gaussian=True, use_mirroring=True),
+}
+
+
+def nnunet_settings(config, preset=None):
+    """Returns the nnU-Net inference settings for the given preset (defaults to the preset in config)"""
+    nnunet_config = config.segmentation.get('nnunet', None)
+    if nnunet_config is None:  # older config files without nnunet block
+        return dict(NNUNET_PRESETS['accurate'])
+    preset = preset or nnunet_config.get('preset', 'accurate')
+    if preset == 'custom':
+        return dict(
+            tile_step_size=float(nnunet_config.tile_step_size),
+            use_gaussian=bool(nnunet_config.use_gaussian),
+            use_mirroring=bool(nnunet_config.use_mirroring),
+        )
+    if preset not in NNUNET_PRESETS:
+        logger.warning(f'Unknown nnU-Net preset "{preset}", falling back to "accurate"')
+        preset = 'accurate'
+
+    return dict(NNUNET_PRESETS[preset])
+
+
+def dice_score(y_true, y_pred, smooth=1):
+    y_true = np.asarray(y_true) > 0
+    y_pred = np.asarray(y_pred) > 0
+    intersection = np.sum(y_true & y_pred)
+    return (2.0 * intersection + smooth) / (np.sum(y_true) + np.sum(y_pred) + smooth)
+
 
 class Predict:
 
@@ -17,6 +50,16 @@ class Predict:
         self.normalize = config.segmentation.normalize
         self.batch_size = config.segmentation.batch_size
         self.conserve_memory = config.segmentation.conserve_memory
+        self.nnunet_settings = nnunet_settings(config)
+        self._nnunet_predictor = None  # cached to avoid reloading the checkpoint for every segmentation
+        self._nnunet_predictor_key = None
+        temporal_config = config.segmentation.get('temporal', {})
+        self.temporal = temporal_config.get('enabled', False)
+        self.keyframe_interval = temporal_config.get('keyframe_interval', 10)
+        self.similarity_threshold = temporal_config.get('similarity_threshold', 0.95)
+        self.propagation = temporal_config.get('propagation', 'warp')
+        self.validate_temporal = temporal_config.get('validate', False)
+        self.temporal_stats = None
         self.images = None
 
     def __call__(self, images, lower_limit, upper_limit) -> None:
@@ -24,7 +67,10 @@ class Predict:
         self.lower_limit = lower_limit
         self.upper_limit = upper_limit
         self.normalisation(self.normalize)
-        mask = self.inference()
+        if self.temporal:
+            mask = self.temporal_inference()
+        else:
+            mask = self.inference()
 
         return mask
 
@@ -78,25 +124,7 @@ class Predict:
                 )
                 mask[self.lower_limit: self.upper_limit, :, :] = np.array(prediction)[0, :, :, :, 0]
         else:
-            from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-            import torch
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            seg_predictor = nnUNetPredictor(
-                tile_step_size=0.5,
-                use_gaussian=True,
-                use_mirroring=True,
-                perform_everything_on_device=True,
-                device=torch.device(device),
-                verbose=False,
-                verbose_preprocessing=False,
-                allow_tqdm=True
-            )
-            # initializes the network architecture, loads the checkpoint
-            seg_predictor.initialize_from_trained_model_folder(
-                self.model_file,
-                use_folds=(self.model_fold,),
-                checkpoint_name="checkpoint_final.pth",
-            )
+            seg_predictor = self.nnunet_predictor()
             print(f"Shape: {self.images.shape}")
             # mask = seg_predictor.predict_from_list_of_npy_arrays([img[None, None, ...] for img in self.images],
             #                                               segs_from_prev_stage_or_list_of_segs_from_prev_stage=None,
@@ -108,6 +136,96 @@ class Predict:
             print(f"mask shape: {mask.shape}")
         return mask
 
+    def temporal_inference(self):
+        """
+        Runs the network only on keyframes and propagates their masks to the frames in between.
+        Keyframes are every keyframe_interval-th frame and frames whose correlation with the last
+        segmented frame drops below similarity_threshold.
+        """
+        images, lower_limit, upper_limit = self.images, self.lower_limit, self.upper_limit
+        keyframes = self.select_keyframes(images[lower_limit:upper_limit]) + lower_limit
+
+        self.images = images[keyframes]
+        self.lower_limit, self.upper_limit = 0, len(keyframes)
+        keyframe_masks = self.inference()
+        self.images, self.lower_limit, self.upper_limit = images, lower_limit, upper_limit
+        if keyframe_masks is None:  # user cancelled
+            return None
+        keyframe_masks = np.asarray(keyframe_masks)
+
+        mask = np.zeros((images.shape[0], *keyframe_masks.shape[1:]), dtype=keyframe_masks.dtype)
+        mask[keyframes] = keyframe_masks
+        propagation = self.propagation
+        if propagation == 'warp' and keyframe_masks.shape[1:] != images.shape[1:]:
+            logger.warning('Masks and images differ in shape, copying masks instead of warping')
+            propagation = 'copy'
+        for frame in range(lower_limit, upper_limit):
+            last_keyframe_index = np.searchsorted(keyframes, frame, side='right') - 1
+            last_keyframe = keyframes[last_keyframe_index]
+            if last_keyframe == frame:
+                continue
+            if propagation == 'warp':
+                mask[frame] = warp_mask(keyframe_masks[last_keyframe_index], images[last_keyframe], images[frame])
+            else:
+                mask[frame] = keyframe_masks[last_keyframe_index]
+
+        self.temporal_stats = dict(inferred=len(keyframes), total=upper_limit - lower_limit, dice=None)
+        if self.validate_temporal:
+            full_mask = self.inference()
+            if full_mask is not None:
+                self.temporal_stats['dice'] = dice_score(
+                    np.asarray(full_mask)[lower_limit:upper_limit], mask[lower_limit:upper_limit]
+                )
+        message = f'Temporal segmentation: inferred {len(keyframes)} of {upper_limit - lower_limit} frames'
+        if self.temporal_stats['dice'] is not None:
+            message += f', dice vs full inference {self.temporal_stats["dice"]:.3f}'
+        logger.info(message)
+
+        return mask
+
+    def select_keyframes(self, frames):
+        """Returns the indices of frames that need to be segmented by the network"""
+        vectors = standardize_frames(frames, stride=4)  # downsampled, correlation is a simple dot product
+        keyframes = [0]
+        for frame in range(1, len(frames)):
+            if (
+                frame - keyframes[-1] >= self.keyframe_interval
+                or np.dot(vectors[frame], vectors[keyframes[-1]]) < self.similarity_threshold
+            ):
+                keyframes.append(frame)
+
+        return np.array(keyframes)
+
+    def nnunet_predictor(self):
+        """Returns the nnU-Net predictor, only re-initialised if the inference settings changed"""
+        settings_key = tuple(sorted(self.nnunet_settings.items()))
+        if self._nnunet_predictor is not None and self._nnunet_predictor_key == settings_key:
+            return self._nnunet_predictor
+
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        logger.info(f'nnU-Net inference settings: {self.nnunet_settings}')
+        seg_predictor = nnUNetPredictor(
+            tile_step_size=self.nnunet_settings['tile_step_size'],
+            use_gaussian=self.nnunet_settings['use_gaussian'],
+            use_mirroring=self.nnunet_settings['use_mirroring'],
+            perform_everything_on_device=True,
+            device=torch.device(device),
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=True
+        )
+        # initializes the network architecture, loads the checkpoint
+        seg_predictor.initialize_from_trained_model_folder(
+            self.model_file,
+            use_folds=(self.model_fold,),
+            checkpoint_name="checkpoint_final.pth",
+        )
+        self._nnunet_predictor = seg_predictor
+        self._nnunet_predictor_key = settings_key
+
+        return seg_predictor
 
     def check_input_shape(self, input_shape, batch_size=16):
         """
@@ -141,3 +259,22 @@ class Predict:
 
             self.images = np.concatenate(reshaped_images, axis=0)
             gc.collect()
+
+
+def warp_mask(mask, source_image, target_image):
+    """Warps the mask of source_image onto target_image using dense optical flow"""
+    flow = cv2.calcOpticalFlowFarneback(
+        to_uint8(target_image), to_uint8(source_image), None, 0.5, 3, 15, 3, 5, 1.2, 0
+    )  # flow from target to source, i.e. target(y, x) ~ source(y + flow_y, x + flow_x)
+    height, width = flow.shape[:2]
+    grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    interpolation = cv2.INTER_NEAREST if np.issubdtype(mask.dtype, np.integer) else cv2.INTER_LINEAR
+    warped = cv2.remap(mask.astype(np.float32), grid_x + flow[..., 0], grid_y + flow[..., 1], interpolation)
+
+    return warped.astype(mask.dtype)
+
+
+def to_uint8(image):
+    if image.dtype == np.uint8:
+        return image
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
@@ -1,17 +1,48 @@
 import os
+import gzip
+import json
+import struct
+import datetime
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
 
+import cv2
 import numpy as np
 import SimpleITK as sitk
 from loguru import logger
-from PyQt5.QtWidgets import QProgressDialog, QApplication
-from PyQt5.QtCore import Qt
-from skimage.draw import polygon2mask
+from matplotlib.path import Path
+from PyQt5.QtWidgets import QProgressDialog
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
 
 from gui.popup_windows.message_boxes import ErrorMessage
 
 import pydicom
-from pydicom.dataset import Dataset
-from pydicom.uid import generate_uid
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import itemize_frame
+from pydicom.encoders import RLELosslessEncoder
+from pydicom.tag import Tag
+from pydicom.uid import generate_uid, RLELossless, MultiFrameGrayscaleByteSecondaryCaptureImageStorage
+
+CHUNK_FRAMES = 64  # frames rasterized and written at once
+SUBPIXEL_BITS = 4  # fractional bits of the contour coordinates for cv2.fillPoly
+NIFTI_HEADER_SIZE = 352  # header (348 bytes) and extension flag, voxel data follows
+NIFTI_DIM_OFFSET = 46  # dim[3] (int16), i.e. the number of frames
+MANIFEST_SUFFIX = '_nifti_export.json'  # contour hashes of the written files, used to skip unchanged files
+DICOM_REFERENCE_ATTRIBUTES = [  # copied from the loaded DICOM file into the exported masks
+    'PatientName',
+    'PatientID',
+    'PatientBirthDate',
+    'PatientSex',
+    'StudyInstanceUID',
+    'StudyDate',
+    'StudyTime',
+    'StudyID',
+    'AccessionNumber',
+    'ReferringPhysicianName',
+]
 
 # def save_as_nifti(main_window, mode=None):
 #     main_window.status_bar.showMessage('Saving frames as NIfTi files...')
@@ -84,6 +115,9 @@ def save_as_nifti(main_window, mode=None):
     if not main_window.image_displayed:
         ErrorMessage(main_window, 'Cannot save as NIfTi before reading input file')
         return
+    if getattr(main_window, 'nifti_export', None) is not None:
+        ErrorMessage(main_window, 'NIfTi files are still being saved')
+        return
 
     out_path = os.path.join(main_window.config.save.nifti_dir, f'{mode}_frames')
     if mode == 'contoured':
@@ -102,67 +136,413 @@ def save_as_nifti(main_window, mode=None):
         return  # nothing to save
 
     if frames_to_save:
-        main_window.status_bar.showMessage('Saving frames as NIfTi files...')
         file_name = os.path.splitext(os.path.basename(main_window.file_name))[0]  # remove file extension
         os.makedirs(out_path, exist_ok=True)
-        mask = contours_to_mask(main_window.images[frames_to_save], frames_to_save, main_window.display.full_contours)
+        contours = {  # snapshot, contours are replaced (not modified) when edited during the export
+            frame: main_window.display.full_contours[frame] if main_window.data['lumen'][0][frame] else None
+            for frame in frames_to_save
+        }
+        export = NiftiExport(
+            main_window.images,
+            contours,
+            any(main_window.data['lumen'][0]),
+            out_path,
+            file_name,
+            main_window.config.save,
+            dicom_reference(main_window) if main_window.config.save.save_dicom else None,
+        )
 
         progress = QProgressDialog()
         progress.setWindowFlags(Qt.Dialog)
-        progress.setModal(True)
         progress.setMinimum(0)
-        progress_max = len(frames_to_save) * main_window.config.save.save_2d + main_window.config.save.save_3d
-        progress.setMaximum(progress_max)
+        progress.setMaximum(len(frames_to_save))
         progress.resize(500, 100)
         progress.setWindowTitle('Saving frames as NIfTi files...')
+        progress.canceled.connect(export.cancel)
+        export.signals.progress.connect(progress.setValue)
+        export.signals.finished.connect(partial(finish_export, main_window, export, progress))
         progress.show()
 
-        if main_window.config.save.save_2d:
-            for i, frame in enumerate(frames_to_save):  # save individual frames as NIfTi
-                progress.setValue(i)
-                QApplication.processEvents()
-                if progress.wasCanceled():
-                    break
-                if main_window.data['lumen'][0][frame]:  # only save mask if contour exists
-                    sitk.WriteImage(
-                        sitk.GetImageFromArray(mask[i, :, :]),
-                        os.path.join(out_path, f'{file_name}_frame_{frame}_seg.nii.gz'),
-                    )
-                sitk.WriteImage(
-                    sitk.GetImageFromArray(main_window.images[frame, :, :]),
-                    os.path.join(out_path, f'{file_name}_frame_{frame}_img.nii.gz'),
+        main_window.nifti_export = export
+        export.start()
+    else:
+        main_window.status_bar.showMessage(main_window.waiting_status)
+
+
+def finish_export(main_window, export, progress, future):
+    progress.close()
+    main_window.nifti_export = None
+    main_window.status_bar.showMessage(main_window.waiting_status)
+    try:
+        canceled = future.result()
+    except Exception as e:
+        logger.exception(e)
+        ErrorMessage(main_window, f'Could not save NIfTi files: {e}')
+        return
+    logger.info(
+        f'NIfTi export{" canceled" if canceled else ""}: {export.written_files} files written, '
+        f'{export.skipped_files} unchanged files skipped'
+    )
+
+
+def dicom_reference(main_window):
+    """Patient and study attributes of the loaded DICOM file (empty for NIfTi input) and the pixel spacing"""
+    reference = Dataset()
+    dicom = getattr(main_window, 'dicom', None)
+    for attribute in DICOM_REFERENCE_ATTRIBUTES:
+        if dicom is not None and attribute in dicom:
+            setattr(reference, attribute, dicom.data_element(attribute).value)
+    if main_window.metadata.get('resolution'):
+        reference.PixelSpacing = [main_window.metadata['resolution']] * 2
+
+    return reference
+
+
+class ExportSignals(QObject):
+    progress = pyqtSignal(int)  # number of processed frames
+    finished = pyqtSignal(object)  # future of the export, returns whether the export was canceled
+
+
+class NiftiExport:
+    """
+    Saves the images and masks of the frames as NIfTi files in a background thread. The frames are processed in
+    chunks, the 2D files of a chunk and the chunk of each 3D volume are written in parallel by a pool of workers (zlib
+    releases the GIL). The contour hash of every written file is kept in a manifest next to the files, files whose
+    contour did not change since the last export are skipped. If a DICOM reference is given, the masks are also
+    streamed into a multi-frame DICOM file.
+    """
+
+    def __init__(self, images, contours, save_seg_3d, out_path, file_name, config, dicom_reference=None):
+        self.images = images
+        self.contours = contours  # contour (or None) by frame to save
+        self.frames = list(contours)
+        self.save_seg_3d = save_seg_3d
+        self.out_path = out_path
+        self.file_name = file_name
+        self.save_2d = config.save_2d
+        self.save_3d = config.save_3d
+        self.compression_level = config.get('nifti_compression', 6)
+        self.extension = '.nii.gz' if self.compression_level > 0 else '.nii'
+        self.dicom_reference = dicom_reference
+        self.manifest_path = os.path.join(out_path, f'{file_name}{MANIFEST_SUFFIX}')
+        self.signals = ExportSignals()
+        self.canceled = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.written_files = 0
+        self.skipped_files = 0
+
+    def start(self):
+        future = self.executor.submit(self.run)
+        future.add_done_callback(self.signals.finished.emit)
+        self.executor.shutdown(wait=False)
+
+    def cancel(self):
+        self.canceled.set()
+
+    def file_path(self, suffix):
+        return os.path.join(self.out_path, f'{self.file_name}{suffix}{self.extension}')
+
+    def run(self):
+        manifest = read_manifest(self.manifest_path)
+        hashes = {frame: contour_hash(contour) for frame, contour in self.contours.items()}
+
+        def pending(file_path, file_hash):
+            if os.path.exists(file_path) and manifest.get(os.path.basename(file_path)) == file_hash:
+                self.skipped_files += 1
+                return False
+            return True
+
+        files_2d = {}  # frame: [(file path, hash, kind)] of the 2D files to write
+        if self.save_2d:
+            for frame in self.frames:
+                files_2d[frame] = []
+                seg_path = self.file_path(f'_frame_{frame}_seg')
+                if self.contours[frame] is None:  # only save mask if contour exists, remove outdated masks
+                    if manifest.pop(os.path.basename(seg_path), None) is not None and os.path.exists(seg_path):
+                        os.remove(seg_path)
+                elif pending(seg_path, hashes[frame]):
+                    files_2d[frame].append((seg_path, hashes[frame], 'seg'))
+                img_path = self.file_path(f'_frame_{frame}_img')
+                if pending(img_path, 'image'):
+                    files_2d[frame].append((img_path, 'image', 'img'))
+
+        volumes = {}  # kind: (file path, hash) of the 3D files to write
+        if self.save_3d:
+            frames_hash = hash_strings(str(frame) for frame in self.frames)
+            if self.save_seg_3d:  # only save mask if any contour exists
+                seg_hash = hash_strings(f'{frame}:{hashes[frame]}' for frame in self.frames)
+                if pending(self.file_path('_seg'), seg_hash):
+                    volumes['seg'] = (self.file_path('_seg'), seg_hash)
+            if pending(self.file_path('_img'), frames_hash):
+                volumes['img'] = (self.file_path('_img'), frames_hash)
+        if self.dicom_reference is not None and self.save_seg_3d:
+            dicom_path = os.path.join(self.out_path, f'{self.file_name}_seg.dcm')
+            seg_hash = hash_strings(f'{frame}:{hashes[frame]}' for frame in self.frames)
+            if pending(dicom_path, seg_hash):
+                volumes['dicom'] = (dicom_path, seg_hash)
+        frame_shape = self.images.shape[1:3]
+        writers = {}
+        for kind, (file_path, _) in volumes.items():
+            if kind == 'dicom':
+                writers[kind] = DicomChunkWriter(file_path, self.frames, frame_shape, self.dicom_reference)
+            else:
+                writers[kind] = NiftiChunkWriter(
+                    file_path,
+                    (len(self.frames), *frame_shape),
+                    np.uint8 if kind == 'seg' else self.images.dtype,
+                    self.compression_level,
                 )
-        if main_window.config.save.save_3d:
-            if any(main_window.data['lumen'][0]):  # only save mask if any contour exists
-                sitk.WriteImage(sitk.GetImageFromArray(mask), os.path.join(out_path, f'{file_name}_seg.nii.gz'))
-            sitk.WriteImage(
-                sitk.GetImageFromArray(main_window.images[frames_to_save]),
-                os.path.join(out_path, f'{file_name}_img.nii.gz'),
+
+        if not writers and not any(files_2d.values()):  # all files unchanged
+            self.signals.progress.emit(len(self.frames))
+            write_manifest(self.manifest_path, manifest)
+            return self.canceled.is_set()
+
+        with ThreadPoolExecutor() as pool:
+            for start in range(0, len(self.frames), CHUNK_FRAMES):
+                if self.canceled.is_set():
+                    break
+                chunk_frames = self.frames[start : start + CHUNK_FRAMES]
+                if 'seg' in writers or 'dicom' in writers:
+                    mask_frames = chunk_frames
+                else:  # only frames with 2D masks to write
+                    mask_frames = [
+                        frame for frame in chunk_frames if any(f[2] == 'seg' for f in files_2d.get(frame, ()))
+                    ]
+                mask = contours_to_mask(self.images, mask_frames, self.contours) if mask_frames else None
+                mask_index = {frame: i for i, frame in enumerate(mask_frames)}
+
+                writes = {}  # future: (file path, hash) of the written 2D file
+                for frame in chunk_frames:
+                    for file_path, file_hash, kind in files_2d.get(frame, ()):
+                        array = mask[mask_index[frame]] if kind == 'seg' else self.images[frame]
+                        future = pool.submit(write_nifti, file_path, array, self.compression_level)
+                        writes[future] = (file_path, file_hash)
+                volume_writes = [pool.submit(writers[kind].write, mask) for kind in ['seg', 'dicom'] if kind in writers]
+                if 'img' in writers:
+                    volume_writes.append(pool.submit(writers['img'].write, self.images[chunk_frames]))
+                for future in volume_writes:
+                    future.result()
+                for future, (file_path, file_hash) in writes.items():
+                    future.result()
+                    manifest[os.path.basename(file_path)] = file_hash
+                    self.written_files += 1
+                self.signals.progress.emit(start + len(chunk_frames))
+
+        canceled = self.canceled.is_set()
+        for kind, writer in writers.items():
+            writer.close(remove=canceled)  # incomplete volumes are removed
+            if not canceled:
+                file_path, file_hash = volumes[kind]
+                manifest[os.path.basename(file_path)] = file_hash
+                self.written_files += 1
+        write_manifest(self.manifest_path, manifest)
+
+        return canceled
+
+
+def contour_hash(contour):
+    """Hash of the contour coordinates, identical contours have identical hashes"""
+    if contour is None:
+        return None
+    sha = hashlib.sha1()
+    for coordinates in contour[:2]:
+        sha.update(np.ascontiguousarray(coordinates, dtype=np.float64).tobytes())
+        sha.update(b'|')
+
+    return sha.hexdigest()
+
+
+def hash_strings(strings):
+    return hashlib.sha1(','.join(strings).encode()).hexdigest()
+
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):  # no export yet or corrupt manifest, all files are written
+        return {}
+
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+
+@lru_cache(maxsize=None)
+def nifti_header(shape, dtype):
+    """
+    NIfTI header (including extension flag) as written by SimpleITK for an array of the given shape ((frames,) height,
+    width). SimpleITK can only write whole images, hence the header is taken from a file with a single frame in which
+    the number of frames is patched.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        header_path = os.path.join(temp_dir, 'header.nii')
+        frame = np.zeros(shape[1:] if len(shape) == 3 else shape, dtype)
+        sitk.WriteImage(sitk.GetImageFromArray(frame[np.newaxis] if len(shape) == 3 else frame), header_path)
+        with open(header_path, 'rb') as header_file:
+            header = bytearray(header_file.read(NIFTI_HEADER_SIZE))
+    if len(shape) == 3:
+        header[NIFTI_DIM_OFFSET : NIFTI_DIM_OFFSET + 2] = np.array(shape[0], dtype=np.int16).tobytes()
+
+    return bytes(header)
+
+
+class NiftiChunkWriter:
+    """
+    Writes an array to a NIfTI file chunk by chunk (along the first axis of the array, i.e. frames), the array is never
+    held in memory as a whole. Files are gzipped (.nii.gz) with the given compression level, 0 writes uncompressed .nii
+    files (much faster, e.g. for intermediate training data).
+    """
+
+    def __init__(self, file_path, shape, dtype, compression_level=6):
+        self.file_path = file_path
+        self.dtype = np.dtype(dtype)
+        self.remaining_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        if compression_level > 0:
+            self.file = gzip.open(file_path, 'wb', compresslevel=compression_level)
+        else:
+            self.file = open(file_path, 'wb')
+        self.file.write(nifti_header(tuple(shape), self.dtype.str))
+
+    def write(self, chunk):
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        self.file.write(data)
+        self.remaining_bytes -= len(data)
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.file_path)
+        elif self.remaining_bytes != 0:
+            logger.warning(f'{self.file_path} is incomplete ({self.remaining_bytes} bytes missing)')
+
+
+class DicomChunkWriter:
+    """
+    Writes masks (uint8, 0 or 1) to a Multi-frame Grayscale Byte Secondary Capture DICOM file chunk by chunk. The
+    frames are RLE compressed and streamed into the encapsulated pixel data, the basic offset table (reserved in front
+    of the frames) is filled in when the file is closed. The frame numbers in the pullback are stored in the frame label
+    vector, patient and study attributes are taken from the reference dataset.
+    """
+
+    def __init__(self, file_path, frames, frame_shape, reference):
+        self.file_path = file_path
+        self.frame_shape = frame_shape
+        self.num_frames = len(frames)
+        self.frame_offsets = []
+
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MultiFrameGrayscaleByteSecondaryCaptureImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = RLELossless
+        dataset = Dataset()
+        dataset.file_meta = file_meta
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        for attribute in DICOM_REFERENCE_ATTRIBUTES:  # type 2 attributes, empty if unknown
+            setattr(dataset, attribute, reference.get(attribute, ''))
+        dataset.StudyInstanceUID = reference.get('StudyInstanceUID') or generate_uid()
+        dataset.SeriesInstanceUID = generate_uid()
+        dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        now = datetime.datetime.now()
+        dataset.Modality = 'OT'
+        dataset.ConversionType = 'WSD'
+        dataset.SeriesNumber = 1
+        dataset.InstanceNumber = 1
+        dataset.SeriesDescription = 'Lumen segmentation'
+        dataset.ContentDate = now.strftime('%Y%m%d')
+        dataset.ContentTime = now.strftime('%H%M%S')
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = 'MONOCHROME2'
+        dataset.Rows, dataset.Columns = frame_shape
+        dataset.BitsAllocated = 8
+        dataset.BitsStored = 8
+        dataset.HighBit = 7
+        dataset.PixelRepresentation = 0
+        if 'PixelSpacing' in reference:
+            dataset.PixelSpacing = reference.PixelSpacing
+        dataset.NumberOfFrames = self.num_frames
+        dataset.FrameIncrementPointer = Tag('FrameLabelVector')
+        dataset.FrameLabelVector = [str(frame) for frame in frames]
+        dataset.WindowCenter = 0.5
+        dataset.WindowWidth = 1
+
+        self.file = open(file_path, 'wb')
+        pydicom.dcmwrite(self.file, dataset, write_like_original=False)
+        self.file.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OB', 0, 0xFFFFFFFF))  # pixel data, undefined length
+        self.file.write(struct.pack('<HHI', 0xFFFE, 0xE000, 4 * self.num_frames))  # basic offset table item
+        self.offset_table_position = self.file.tell()
+        self.file.write(bytes(4 * self.num_frames))
+        self.first_frame_position = self.file.tell()
+
+    def write(self, chunk):
+        for frame in chunk:
+            encoded = RLELosslessEncoder.encode(
+                np.ascontiguousarray(frame, dtype=np.uint8),
+                rows=self.frame_shape[0],
+                columns=self.frame_shape[1],
+                samples_per_pixel=1,
+                bits_allocated=8,
+                bits_stored=8,
+                photometric_interpretation='MONOCHROME2',
+                pixel_representation=0,
+                number_of_frames=1,
             )
-            progress.setValue(len(frames_to_save) * main_window.config.save.save_2d + 1)
-            QApplication.processEvents()
+            self.frame_offsets.append(self.file.tell() - self.first_frame_position)
+            for item in itemize_frame(encoded):
+                self.file.write(item)
+
+    def close(self, remove=False):
+        self.file.write(struct.pack('<HHI', 0xFFFE, 0xE0DD, 0))  # sequence delimiter
+        if len(self.frame_offsets) == self.num_frames:
+            self.file.seek(self.offset_table_position)
+            self.file.write(struct.pack(f'<{self.num_frames}I', *self.frame_offsets))
+        self.file.close()
+        if remove:
+            os.remove(self.file_path)
+        elif len(self.frame_offsets) != self.num_frames:
+            logger.warning(f'{self.file_path} has {len(self.frame_offsets)} instead of {self.num_frames} frames')
 
-        progress.close()
-        main_window.status_bar.showMessage(main_window.waiting_status)
 
-        # Call DICOM conversion function
-        if main_window.config.save.save_dicom:  # Add a config flag to enable/disable DICOM conversion
-            convert_nifti_to_dicom(main_window, out_path, file_name, frames_to_save)
-    
-def convert_nifti_to_dicom(main_window, out_path, file_name, frames_to_save):
-    pass
+def write_nifti(file_path, array, compression_level=6):
+    writer = NiftiChunkWriter(file_path, array.shape, array.dtype, compression_level)
+    writer.write(array)
+    writer.close()
 
 
-def contours_to_mask(images, contoured_frames, contours):
-    """Convert IVUS contours to numpy mask"""
-    image_shape = images.shape[1:3]
-    mask = np.zeros_like(images)
-    for i, frame in enumerate(contoured_frames):
+def contours_to_mask(images, contoured_frames, contours, out=None):
+    """
+    Convert IVUS contours to uint8 mask (one frame per contoured frame), frames are rasterized in parallel. The mask is
+    written into out if given (zero-initialized, e.g. a memory-mapped array).
+    """
+    mask = np.zeros((len(contoured_frames), *images.shape[1:3]), dtype=np.uint8) if out is None else out
+
+    def rasterize(i):
         try:
-            lumen_polygon = [[x, y] for x, y in zip(contours[frame][1], contours[frame][0])]
-            mask[i, :, :] += polygon2mask(image_shape, lumen_polygon).astype(np.uint8)
-        except (TypeError, ValueError):  # frame has no lumen contours
+            rasterize_contour(mask[i], contours[contoured_frames[i]])
+        except (TypeError, ValueError, IndexError):  # frame has no lumen contours
             pass
-    mask = np.clip(mask, a_min=0, a_max=1)  # enforce correct value range
+
+    with ThreadPoolExecutor() as executor:  # OpenCV releases the GIL
+        list(executor.map(rasterize, range(len(contoured_frames))))
 
     return mask
+
+
+def rasterize_contour(mask, contour):
+    """
+    Fills the contour (x and y coordinates) into the mask with ones, in place. Same result as skimage's polygon2mask
+    (pixels whose center lies inside the polygon): cv2.fillPoly also fills pixels that are only touched by the
+    contour, hence only the border pixels are checked with an exact point in polygon test.
+    """
+    points = np.stack([np.asarray(contour[0], dtype=float), np.asarray(contour[1], dtype=float)], axis=1)
+    if len(points) < 3:
+        return
+    cv2.fillPoly(mask, [np.round(points * 2**SUBPIXEL_BITS).astype(np.int32)], 1, cv2.LINE_8, SUBPIXEL_BITS)
+    border = mask - cv2.erode(mask, np.ones((3, 3), np.uint8))
+    rows, cols = np.nonzero(border)
+    inside = Path(points).contains_points(np.stack([cols, rows], axis=1))
+    mask[rows[~inside], cols[~inside]] = 0
@@ -5,6 +5,7 @@ from skimage import measure
 
 from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
 from gui.popup_windows.frame_range_dialog import FrameRangeDialog
+from input_output.contours_io import bump_contour_version
 
 
 def segment(main_window):
@@ -22,9 +23,7 @@ def segment(main_window):
         masks = main_window.predictor(main_window.images, lower_limit, upper_limit)
         if masks is not None:
             main_window.data['lumen'] = mask_to_contours(main_window, masks, lower_limit, upper_limit)
-            main_window.data['lumen_area'] = [0] * main_window.metadata[
-                'num_frames'
-            ]  # ensure all metrics are recalculated for the report
+            bump_contour_version(main_window.data, range(lower_limit, upper_limit))  # metrics are recalculated
             main_window.contours_drawn = True
             main_window.display.set_data(main_window.data['lumen'], main_window.images)
             main_window.hide_contours_box.setChecked(False)
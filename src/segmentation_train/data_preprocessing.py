@@ -114,9 +114,16 @@ def reg_data_prep(img_list: List[str], mask_list: List[str]) -> Tuple[np.ndarray
     return img_data_set, mask_data_set
 
 
+def load_file(fpath):
+    """NIfTI file or .npy stack (frames, height, width), e.g. the gated images and masks saved by the GUI"""
+    if fpath.endswith('.npy'):
+        return np.load(fpath, mmap_mode='r')
+    return load_nii_file(fpath)
+
+
 def read_data(img_path, mask_path):
-    img_data = load_nii_file(img_path)
-    mask_data = load_nii_file(mask_path)
+    img_data = load_file(img_path)
+    mask_data = load_file(mask_path)
     mask_data = np.expand_dims(mask_data, axis=3).astype(np.int8)
     img_data = np.expand_dims(img_data, axis=3)
     return img_data, mask_data
\ No newline at end of file